@@ -0,0 +1,118 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Mongo Document State Caches"""
+from __future__ import absolute_import
+import collections
+import repoze.lru
+import zope.interface
+
+from mongopersist import interfaces
+
+
+class StateCache(object):
+    """A bounded LRU cache of document states keyed by DBRef.
+
+    The cache is meant to be shared by several data managers and survives
+    transaction boundaries. The data manager only uses a cached state, if its
+    serial matches the serial currently stored in Mongo.
+    """
+    zope.interface.implements(interfaces.IStateCache)
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._lru = repoze.lru.LRUCache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, dbref):
+        doc = self._lru.get(dbref)
+        if doc is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return doc
+
+    def put(self, dbref, doc):
+        self._lru.put(dbref, doc)
+
+    def invalidate(self, dbref):
+        self._lru.invalidate(dbref)
+
+    def clear(self):
+        self._lru.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class ContainerKeyCache(StateCache):
+    """A bounded LRU cache mapping container keys to the DBRefs of the items.
+
+    The keys are tuples identifying the container and the item key. Like the
+    state cache, it is shared by several data managers and the container only
+    uses an entry, if the document state found via the data manager's state
+    cache still matches the container and key.
+    """
+
+
+class ContainerCache(object):
+    """A bounded LRU mapping of container keys to loaded items.
+
+    Once an item was evicted, the cache can never be complete again.
+    """
+    zope.interface.implements(interfaces.IContainerCache)
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._data = collections.OrderedDict()
+        self.evicted = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evicted = True
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data.keys())
+
+    def __len__(self):
+        return len(self._data)
+
+    def iteritems(self):
+        return iter(self._data.items())
@@ -29,6 +29,62 @@ def u64(v):
 def create_conflict_error(obj, orig_doc, cur_doc, new_doc):
     return interfaces.ConflictError(None, obj, orig_doc, cur_doc, new_doc)
 
+# Marks a field that is not present in a document.
+MISSING = object()
+
+def merge_last_writer_wins(orig, cur, new):
+    return new
+
+def merge_add(orig, cur, new):
+    """Apply the numeric change of the new state to the current state."""
+    orig = 0 if orig is MISSING else orig
+    cur = 0 if cur is MISSING else cur
+    new = 0 if new is MISSING else new
+    return cur + (new - orig)
+
+def merge_union(orig, cur, new):
+    """Add the items of the new list that are not in the current list."""
+    cur = [] if cur is MISSING else list(cur)
+    if new is not MISSING:
+        cur.extend([item for item in new if item not in cur])
+    return cur
+
+MERGE_STRATEGIES = {
+    'last-writer-wins': merge_last_writer_wins,
+    'add': merge_add,
+    'union': merge_union,
+    }
+
+def merge_documents(orig_doc, cur_doc, new_doc, strategies, ignore=()):
+    """Merge the changes of two documents based on their original version.
+
+    Fields changed in only one document are taken from it. Fields changed
+    in both documents are merged using the strategy declared for the field,
+    which is either a name in ``MERGE_STRATEGIES`` or a callable. ``None`` is
+    returned, if a field cannot be merged.
+    """
+    merged = {}
+    names = set(orig_doc) | set(cur_doc) | set(new_doc)
+    names.difference_update(ignore)
+    for name in names:
+        orig = orig_doc.get(name, MISSING)
+        cur = cur_doc.get(name, MISSING)
+        new = new_doc.get(name, MISSING)
+        if new == orig or new == cur:
+            value = cur
+        elif cur == orig:
+            value = new
+        else:
+            strategy = strategies.get(name)
+            if strategy is None:
+                return None
+            if not callable(strategy):
+                strategy = MERGE_STRATEGIES[strategy]
+            value = strategy(orig, cur, new)
+        if value is not MISSING:
+            merged[name] = value
+    return merged
+
 class NoCheckConflictHandler(object):
     zope.interface.implements(interfaces.IConflictHandler)
 
@@ -61,6 +117,7 @@ class SerialConflictHandler(object):
     zope.interface.implements(interfaces.IResolvingConflictHandler)
 
     field_name = '_py_serial'
+    compare_and_swap = False
     conflict_error_factory = staticmethod(create_conflict_error)
 
     def __init__(self, datamanager):
@@ -84,45 +141,61 @@ class SerialConflictHandler(object):
         if orig_state is None:
             # This should never happen in a real running system.
             return False
-        orig_state = orig_state.copy()
-        try:
-            orig_state.pop(self.field_name)
-        except KeyError:
-            pass
-        new_state = new_state.copy()
-        try:
-            new_state.pop(self.field_name)
-        except KeyError:
-            pass
-        return orig_state == new_state
+        # Compare the states without copying them, ignoring the serial.
+        field_name = self.field_name
+        if (len(orig_state) - (field_name in orig_state) !=
+            len(new_state) - (field_name in new_state)):
+            return False
+        for name, value in new_state.iteritems():
+            if name == field_name:
+                continue
+            if orig_state.get(name, MISSING) != value:
+                return False
+        return True
 
     def resolve(self, obj, orig_doc, cur_doc, new_doc):
         raise NotImplementedError
 
+    def _resolve_conflict(self, obj, coll):
+        orig_doc = self.datamanager._original_states.get(obj._p_oid)
+        cur_doc = coll.find_one(obj._p_oid.id)
+        new_doc = self.datamanager._writer.get_full_state(obj)
+        resolved = self.resolve(obj, orig_doc, cur_doc, new_doc)
+        if not resolved:
+            return self.conflict_error_factory(
+                obj, orig_doc, cur_doc, new_doc)
+
+    def _find_conflicting_objects(self, objs):
+        # Group the objects by collection, so that the serials of all objects
+        # can be looked up using one query per collection.
+        by_coll = {}
+        for obj in objs:
+            # This object is not even added to the database yet, so there
+            # cannot be a conflict.
+            if obj._p_oid is None:
+                continue
+            by_coll.setdefault(
+                (obj._p_oid.database, obj._p_oid.collection), {}
+                )[obj._p_oid.id] = obj
+        for (db_name, coll_name), objs_by_id in by_coll.items():
+            coll = self.datamanager._get_collection(db_name, coll_name)
+            if len(objs_by_id) == 1:
+                spec = {'_id': objs_by_id.keys()[0]}
+            else:
+                spec = {'_id': {'$in': objs_by_id.keys()}}
+            for cur_doc in coll.find(spec, fields=(self.field_name,)):
+                obj = objs_by_id[cur_doc['_id']]
+                if cur_doc.get(self.field_name, 0) != u64(obj._p_serial):
+                    yield obj, coll
+
     def check_conflict(self, obj):
-        # This object is not even added to the database yet, so there
-        # cannot be a conflict.
-        if obj._p_oid is None:
-            return
-        # make sure we use the same db and collection as in the object
-        coll = self.datamanager._get_collection(
-            obj._p_oid.database, obj._p_oid.collection)
-        cur_doc = coll.find_one(obj._p_oid.id, fields=(self.field_name,))
-        if cur_doc is None:
-            return
-        if cur_doc.get(self.field_name, 0) != u64(obj._p_serial):
-            orig_doc = self.datamanager._original_states.get(obj._p_oid)
-            cur_doc = coll.find_one(obj._p_oid.id)
-            new_doc = self.datamanager._writer.get_full_state(obj)
-            resolved = self.resolve(obj, orig_doc, cur_doc, new_doc)
-            if not resolved:
-                return self.conflict_error_factory(
-                    obj, orig_doc, cur_doc, new_doc)
+        for obj, coll in self._find_conflicting_objects([obj]):
+            return self._resolve_conflict(obj, coll)
 
     def has_conflicts(self, objs):
-        for obj in objs:
+        for obj, coll in self._find_conflicting_objects(objs):
             try:
-                if self.check_conflict(obj) is not None:
+                if self._resolve_conflict(obj, coll) is not None:
                     return True
             except interfaces.ConflictError, err:
                 # In some cases even trying to resolve the conflict causes a
@@ -132,8 +205,8 @@ class SerialConflictHandler(object):
         return False
 
     def check_conflicts(self, objs):
-        for obj in objs:
-            err = self.check_conflict(obj)
+        for obj, coll in self._find_conflicting_objects(objs):
+            err = self._resolve_conflict(obj, coll)
             if err is not None:
                 raise err
 
@@ -147,10 +220,44 @@ class SimpleSerialConflictHandler(SerialConflictHandler):
 class ResolvingSerialConflictHandler(SerialConflictHandler):
 
     def resolve(self, obj, orig_doc, cur_doc, new_doc):
+        doc = None
         if hasattr(obj, '_p_resolveConflict'):
             doc = obj._p_resolveConflict(orig_doc, cur_doc, new_doc)
-            if doc is not None:
-                doc[self.field_name] = cur_doc[self.field_name]
-                self.datamanager._reader.set_ghost_state(obj, doc)
-                return True
+        elif (getattr(obj, '_p_mongo_merge', None) is not None and
+              orig_doc is not None):
+            doc = merge_documents(
+                orig_doc, cur_doc, new_doc, obj._p_mongo_merge,
+                ignore=('_id', self.field_name))
+        if doc is not None:
+            doc[self.field_name] = cur_doc[self.field_name]
+            self.datamanager._reader.set_ghost_state(obj, doc)
+            return True
         return False
+
+
+class CompareAndSwapConflictHandler(ResolvingSerialConflictHandler):
+    zope.interface.implements(interfaces.ICompareAndSwapConflictHandler)
+
+    compare_and_swap = True
+
+    def get_store_spec(self, obj):
+        serial = u64(getattr(obj, '_p_serial', p64(0)))
+        spec = {'_id': obj._p_oid.id, self.field_name: serial}
+        if not serial:
+            # Documents that were never written with a serial do not have the
+            # field at all.
+            spec[self.field_name] = {'$in': [serial, None]}
+        return spec
+
+    def resolve_store_conflict(self, obj, coll):
+        orig_doc = self.datamanager._original_states.get(obj._p_oid)
+        cur_doc = coll.find_one(obj._p_oid.id)
+        new_doc = self.datamanager._writer.get_full_state(obj)
+        if (cur_doc is None or
+            not self.resolve(obj, orig_doc, cur_doc, new_doc)):
+            raise self.conflict_error_factory(
+                obj, orig_doc, cur_doc, new_doc)
+
+    def check_conflicts(self, objs):
+        # Conflicts are detected while writing.
+        pass
@@ -18,12 +18,15 @@ import bson
 import logging
 import transaction
 import sys
+import threading
 import zope.interface
 
 from zope.exceptions import exceptionformatter
 from mongopersist import conflict, interfaces, serialize
 
 MONGO_ACCESS_LOGGING = False
+BULK_FLUSH = False
+PARALLEL_LOADS = False
 COLLECTION_LOG = logging.getLogger('mongopersist.collection')
 
 LOG = logging.getLogger(__name__)
@@ -72,6 +75,19 @@ class ProcessSpecDecorator(object):
         return self.function(*args, **kwargs)
 
 
+class ReadRoutingDecorator(object):
+
+    def __init__(self, collection, datamanager, name):
+        self.collection = collection
+        self.datamanager = datamanager
+        self.name = self.__name__ = name
+
+    def __call__(self, *args, **kwargs):
+        coll = self.datamanager._get_read_collection(
+            self.collection.database.name, self.collection.name)
+        return getattr(coll, self.name)(*args, **kwargs)
+
+
 class LoggingDecorator(object):
 
     # these are here to be easily patched
@@ -83,14 +99,15 @@ class LoggingDecorator(object):
         self.function = function
 
     def __call__(self, *args, **kwargs):
+        self.log(args, kwargs, sys._getframe(1))
+        return self.function(*args, **kwargs)
+
+    def log(self, args, kwargs, frame):
         if self.ADD_TB:
-            try:
-                raise ValueError('boom')
-            except:
-                # we need here exceptionformatter, otherwise __traceback_info__
-                # is not added
-                tb = ''.join(exceptionformatter.extract_stack(
-                    sys.exc_info()[2].tb_frame.f_back, limit=self.TB_LIMIT))
+            # we need here exceptionformatter, otherwise __traceback_info__
+            # is not added
+            tb = ''.join(exceptionformatter.extract_stack(
+                frame, limit=self.TB_LIMIT))
         else:
             tb = '  <omitted>'
 
@@ -102,8 +119,6 @@ class LoggingDecorator(object):
             self.collection.database.name, self.collection.name,
             self.function.__name__, txn, args, kwargs, tb)
 
-        return self.function(*args, **kwargs)
-
 
 class CollectionWrapper(object):
 
@@ -112,6 +127,9 @@ class CollectionWrapper(object):
     QUERY_METHODS = ['group', 'map_reduce', 'inline_map_reduce', 'find_one',
                      'find', 'find_and_modify', 'aggregate', 'distinct', 'count']
     PROCESS_SPEC_METHODS = ['find_and_modify', 'find_one', 'find']
+    WRITE_METHODS = ['insert', 'update', 'remove', 'save', 'find_and_modify',
+                     'initialize_ordered_bulk_op',
+                     'initialize_unordered_bulk_op']
 
     def __init__(self, collection, datamanager):
         self.__dict__['collection'] = collection
@@ -136,6 +154,13 @@ class CollectionWrapper(object):
 
     def __getattr__(self, name):
         attr = getattr(self.collection, name)
+        if name in self.WRITE_METHODS:
+            self._datamanager._dirty_collections.add(
+                (self.collection.database.name, self.collection.name))
+        elif (name in self.QUERY_METHODS and
+              self._datamanager.read_connection is not None):
+            attr = ReadRoutingDecorator(
+                self.collection, self._datamanager, name)
         if MONGO_ACCESS_LOGGING and name in self.LOGGED_METHODS:
             attr = LoggingDecorator(self.collection, attr)
         if name in self.QUERY_METHODS:
@@ -195,11 +220,14 @@ class MongoDataManager(object):
     default_database = 'mongopersist'
     name_map_collection = 'persistence_name_map'
     conflict_handler = None
+    state_cache = None
+    read_connection = None
 
     def __init__(self, conn, default_database=None,
                  root_database=None, root_collection=None,
                  name_map_collection=None,
-                 conflict_handler_factory=conflict.NoCheckConflictHandler):
+                 conflict_handler_factory=conflict.NoCheckConflictHandler,
+                 state_cache=None, read_connection=None):
         self._conn = conn
         self._reader = serialize.ObjectReader(self)
         self._writer = serialize.ObjectWriter(self)
@@ -208,6 +236,12 @@ class MongoDataManager(object):
         # which can have undesired side effects. `id()` is guaranteed to not
         # use any method or state of the object itself.
         self._registered_objects = {}
+        # Objects registered while flushing, so that they can be written
+        # without scanning all registered objects again.
+        self._flush_queue = []
+        # Registered objects grouped by the id of their document object, so
+        # that all registered sub-objects of a document can be found quickly.
+        self._registered_doc_objects = {}
         self._loaded_objects = {}
         self._inserted_objects = {}
         self._modified_objects = {}
@@ -218,6 +252,12 @@ class MongoDataManager(object):
         # original states, since changes can be flushed to the database
         # multiple times per transaction.
         self._latest_states = {}
+        # The collections written to in this transaction. They are never read
+        # using the read connection.
+        self._dirty_collections = set()
+        # Objects whose deferred attributes have not been loaded yet, keyed
+        # by DBRef.
+        self._deferred_objects = {}
         self._needs_to_join = True
         self._object_cache = {}
         self.annotations = {}
@@ -227,12 +267,24 @@ class MongoDataManager(object):
             self.default_database = default_database
         if name_map_collection is not None:
             self.name_map_collection = name_map_collection
+        if state_cache is not None:
+            self.state_cache = state_cache
+        if read_connection is not None:
+            self.read_connection = read_connection
         self.transaction_manager = transaction.manager
         self.root = Root(self, root_database, root_collection)
 
     def _get_collection(self, db_name, coll_name):
         return self._conn[db_name][coll_name]
 
+    def _get_read_collection(self, db_name, coll_name):
+        # To read our own writes, collections written to in this transaction
+        # are always read using the primary connection.
+        if (self.read_connection is None or
+            (db_name, coll_name) in self._dirty_collections):
+            return self._get_collection(db_name, coll_name)
+        return self.read_connection[db_name][coll_name]
+
     def _get_collection_from_object(self, obj):
         db_name, coll_name = self._writer.get_collection_name(obj)
         return self._get_collection(db_name, coll_name)
@@ -243,25 +295,38 @@ class MongoDataManager(object):
         written = set()
         # Make sure that we do not compute the list of flushable objects all
         # at once. While writing objects, new sub-objects might be registered
-        # that also need saving.
-        todo = set(self._registered_objects.keys())
+        # that also need saving. Those are collected in the flush queue by
+        # `register()` and written in the next round.
+        todo = self._registered_objects.values()
+        self._flush_queue = []
         while todo:
-            obj_id = todo.pop()
-            obj = self._registered_objects[obj_id]
-            __traceback_info__ = obj
-            obj = self._get_doc_object(obj)
-            self._writer.store(obj)
-            written.add(obj_id)
-            todo = set(self._registered_objects.keys()) - written
+            # Several registered sub-objects can share the same document
+            # object, which only needs to be written once per round.
+            doc_objs = {}
+            for obj in todo:
+                obj_id = id(obj)
+                if obj_id in written or obj_id not in self._registered_objects:
+                    continue
+                written.add(obj_id)
+                __traceback_info__ = obj
+                obj = self._get_doc_object(obj)
+                doc_objs[id(obj)] = obj
+            if BULK_FLUSH:
+                self._writer.store_many(doc_objs.values())
+            else:
+                for obj in doc_objs.values():
+                    __traceback_info__ = obj
+                    self._writer.store(obj)
+            todo, self._flush_queue = self._flush_queue, []
 
     def _get_doc_object(self, obj):
-        seen = []
+        seen = set()
         # Make sure we write the object representing a document in a
         # collection and not a sub-object.
         while getattr(obj, '_p_mongo_sub_object', False):
             if id(obj) in seen:
                 raise interfaces.CircularReferenceError(obj)
-            seen.append(id(obj))
+            seen.add(id(obj))
             obj = obj._p_mongo_doc_object
         return obj
 
@@ -276,11 +341,101 @@ class MongoDataManager(object):
         if id(obj) in self._registered_objects:
             obj._p_changed = False
             del self._registered_objects[id(obj)]
+            doc_obj = self._get_doc_object(obj)
+            self._registered_doc_objects.get(id(doc_obj), {}).pop(id(obj), None)
         return res
 
     def load(self, dbref, klass=None):
         return self._reader.get_ghost(dbref, klass)
 
+    def _load_states(self, dbrefs):
+        # Group the references of all documents that are not loaded yet by
+        # collection, so that every collection is only queried once.
+        missing = {}
+        for dbref in dbrefs:
+            if dbref in self._latest_states:
+                continue
+            obj = self._object_cache.get(hash(dbref))
+            if obj is not None and obj._p_changed is not None:
+                # The object is already active.
+                continue
+            missing.setdefault(
+                (dbref.database, dbref.collection), set()).add(dbref.id)
+        if PARALLEL_LOADS and len(missing) > 1:
+            results = self._find_parallel(missing)
+        else:
+            results = [
+                (db_name, coll_name,
+                 self.get_collection(db_name, coll_name).find(
+                     {'_id': {'$in': list(ids)}}))
+                for (db_name, coll_name), ids in missing.items()]
+        # Now dump the states into the _latest_states dictionary, so that
+        # setstate() can pick them up without accessing Mongo.
+        for db_name, coll_name, docs in results:
+            for doc in docs:
+                dbref = bson.dbref.DBRef(coll_name, doc['_id'], db_name)
+                self._latest_states[dbref] = doc
+
+    def _find_parallel(self, missing):
+        # Query all collections at the same time, so that the round trips
+        # overlap. Flush first, so that the threads do not have to.
+        self.flush()
+        # The specs are processed and logged just like by get_collection(),
+        # but in this thread, since the site and transaction are local to it.
+        queries = []
+        for (db_name, coll_name), ids in missing.items():
+            coll = self._get_collection(db_name, coll_name)
+            spec = process_spec(coll, {'_id': {'$in': list(ids)}})
+            if MONGO_ACCESS_LOGGING:
+                LoggingDecorator(coll, coll.find).log(
+                    (spec,), {}, sys._getframe())
+            queries.append((db_name, coll_name, spec))
+        results = []
+        errors = []
+        def find(db_name, coll_name, spec):
+            try:
+                coll = self._get_read_collection(db_name, coll_name)
+                docs = list(coll.find(spec))
+            except:
+                errors.append(sys.exc_info())
+            else:
+                results.append((db_name, coll_name, docs))
+        threads = [threading.Thread(target=find, args=query)
+                   for query in queries]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def _prefetch_references(self, dbrefs):
+        # Load the documents referenced by the given documents at once, if
+        # their classes ask for the references to be prefetched.
+        refs = []
+        for dbref in dbrefs:
+            doc = self._latest_states.get(dbref)
+            if doc is None:
+                continue
+            obj = self._object_cache.get(hash(dbref))
+            klass = obj.__class__ if obj is not None \
+                else self._reader.resolve(dbref)
+            refs.extend(self._reader.get_prefetch_refs(klass, doc))
+        if refs:
+            self._load_states(refs)
+
+    def load_many(self, dbrefs, klass=None):
+        dbrefs = list(dbrefs)
+        self._load_states(dbrefs)
+        self._prefetch_references(dbrefs)
+        return [self.load(dbref, klass) for dbref in dbrefs]
+
+    def prefetch(self, objs):
+        dbrefs = [obj._p_oid for obj in objs if obj._p_oid is not None]
+        self._load_states(dbrefs)
+        self._prefetch_references(dbrefs)
+
     def reset(self):
         root = self.root
         self.__init__(self._conn)
@@ -292,10 +447,15 @@ class MongoDataManager(object):
         # Now write every registered object, but make sure we write each
         # object just once.
         self._flush_objects()
+        self._reset_registered_objects()
+
+    def _reset_registered_objects(self):
         # Let's now reset all objects as if they were not modified:
         for obj in self._registered_objects.values():
             obj._p_changed = False
         self._registered_objects = {}
+        self._registered_doc_objects = {}
+        self._flush_queue = []
 
     def insert(self, obj, oid=None):
         if obj._p_oid is not None:
@@ -306,6 +466,32 @@ class MongoDataManager(object):
         self._inserted_objects[id(obj)] = obj
         return res
 
+    def insert_many(self, objs, ids=None):
+        objs = list(objs)
+        for obj in objs:
+            if obj._p_oid is not None:
+                raise ValueError('Object has already an OID.', obj)
+        # The inserted objects must be removed again, if the transaction is
+        # aborted, even if they are never modified.
+        if self._needs_to_join:
+            self.transaction_manager.get().join(self)
+            self._needs_to_join = False
+        # Register the objects before writing, so that documents written
+        # before a failure are removed on abort as well.
+        for obj in objs:
+            self._inserted_objects[id(obj)] = obj
+        try:
+            res = self._writer.insert_many(objs, ids)
+        except:
+            # The writer removed the objects again, unless that failed too.
+            for obj in objs:
+                if obj._p_oid is None:
+                    del self._inserted_objects[id(obj)]
+            raise
+        for obj in objs:
+            obj._p_changed = False
+        return res
+
     def remove(self, obj):
         if obj._p_oid is None:
             raise ValueError('Object does not have OID.', obj)
@@ -313,11 +499,15 @@ class MongoDataManager(object):
         # have the state in case we abort the transaction later.
         if obj._p_changed is None:
             self.setstate(obj)
+        if obj._p_oid in self._deferred_objects:
+            self.load_deferred(obj)
         # Now we remove the object from Mongo.
         coll = self.get_collection_from_object(obj)
         coll.remove({'_id': obj._p_oid.id})
         if hash(obj._p_oid) in self._object_cache:
             del self._object_cache[hash(obj._p_oid)]
+        if self.state_cache is not None:
+            self.state_cache.invalidate(obj._p_oid)
 
         # Edge case: The object was just added in this transaction.
         if id(obj) in self._inserted_objects:
@@ -329,9 +519,8 @@ class MongoDataManager(object):
         # Just in case the object was modified before removal, let's remove it
         # from the modification list. Note that all sub-objects need to be
         # deleted too!
-        for key, reg_obj in self._registered_objects.items():
-            if self._get_doc_object(reg_obj) is obj:
-                del self._registered_objects[key]
+        for key in self._registered_doc_objects.pop(id(obj), ()):
+            self._registered_objects.pop(key, None)
         # We are not doing anything fancy here, since the object might be
         # added again with some different state.
 
@@ -351,6 +540,9 @@ class MongoDataManager(object):
         self._reader.set_ghost_state(obj, doc)
         self._loaded_objects[id(obj)] = obj
 
+    def load_deferred(self, obj):
+        self._reader.set_deferred_state(obj)
+
     def oldstate(self, obj, tid):
         # I cannot find any code using this method. Also, since we do not keep
         # version history, we always raise an error.
@@ -363,16 +555,23 @@ class MongoDataManager(object):
 
         # Do not bring back removed objects. But only main the document
         # objects can be removed, so check for that.
-        if id(self._get_doc_object(obj)) in self._removed_objects:
+        doc_obj = self._get_doc_object(obj)
+        if id(doc_obj) in self._removed_objects:
             return
+        # A partially loaded document must be complete before it is changed,
+        # so that it can be written and restored correctly.
+        if getattr(doc_obj, '_p_oid', None) in self._deferred_objects:
+            self.load_deferred(doc_obj)
 
         if obj is not None:
             if id(obj) not in self._registered_objects:
                 self._registered_objects[id(obj)] = obj
-            if id(obj) not in self._modified_objects:
-                obj = self._get_doc_object(obj)
-                self._modified_objects[id(obj)] = obj
-            self.conflict_handler.on_modified(obj)
+                self._registered_doc_objects.setdefault(
+                    id(doc_obj), {})[id(obj)] = obj
+                self._flush_queue.append(obj)
+            if id(doc_obj) not in self._modified_objects:
+                self._modified_objects[id(doc_obj)] = doc_obj
+            self.conflict_handler.on_modified(doc_obj)
 
     def abort(self, transaction):
         # Aborting the transaction requires three steps:
@@ -417,6 +616,12 @@ class MongoDataManager(object):
 
     def commit(self, transaction):
         self.conflict_handler.check_conflicts(self._registered_objects.values())
+        # Compare-and-swap handlers only detect conflicts while writing, so
+        # the changes must be written before the vote. Otherwise a conflict
+        # would only be raised in the second phase of the commit.
+        if getattr(self.conflict_handler, 'compare_and_swap', False):
+            self._flush_objects()
+            self._reset_registered_objects()
 
     def tpc_begin(self, transaction):
         pass
@@ -108,6 +108,7 @@ class IConflictHandler(zope.interface.Interface):
         """Checks whether any of the passed in objects have conflicts.
 
         Raises a ``ConflictError`` for the first object with a conflict.
+        Implementations should check all objects of a collection at once.
 
         While calling this method, the conflict handler may try to resolve
         conflicts.
@@ -125,6 +126,37 @@ class IResolvingConflictHandler(IConflictHandler):
 
         It is the responsibility of this method to modify the object and data
         manager models, so that the resolution is valid in the next step.
+
+        Objects can resolve conflicts themselves by implementing
+        ``_p_resolveConflict(orig_doc, cur_doc, new_doc)``. Alternatively
+        their class can declare a ``_p_mongo_merge`` mapping of field names
+        to merge strategies, so that the documents are merged field by field.
+        """
+
+
+class ICompareAndSwapConflictHandler(IResolvingConflictHandler):
+    """A conflict handler that detects conflicts while writing.
+
+    Documents are only updated, if their serial still matches the serial of
+    the object. No documents have to be read before committing.
+
+    The connection must acknowledge writes, since otherwise it cannot be
+    known whether a document was matched. Unacknowledged writes raise a
+    ``ValueError``.
+    """
+
+    compare_and_swap = zope.interface.Attribute(
+        """Always true; tells the object writer to use ``get_store_spec()``
+        and ``resolve_store_conflict()``.""")
+
+    def get_store_spec(obj):
+        """Return the spec matching the object's document at its serial."""
+
+    def resolve_store_conflict(obj, coll):
+        """Called when the object's document was not matched while writing.
+
+        The conflict is either resolved by updating the object, so that it
+        can be written again, or a ``ConflictError`` is raised.
         """
 
 
@@ -134,14 +166,22 @@ class IObjectSerializer(zope.interface.Interface):
 
     def can_read(state):
         """Returns a boolean indicating whether this serializer can deserialize
-        this state."""
+        this state.
+
+        The result is cached, so it must only depend on the type of the state
+        and, for dictionaries, the value of the ``_py_type`` field.
+        """
 
     def get_object(state):
         """Convert the state to an object."""
 
     def can_write(obj):
         """Returns a boolean indicating whether this serializer can serialize
-        this object."""
+        this object.
+
+        The result is cached, so it must only depend on the type of the
+        object.
+        """
 
     def get_state(obj):
         """Convert the object to a state/document."""
@@ -169,6 +209,28 @@ class IObjectWriter(zope.interface.Interface):
         If id is not specified, unique one will be generated
         """
 
+    def insert_many(objs, ids=None):
+        """Insert new objects using one insert per collection.
+
+        All ids are assigned before the states are computed, so that the new
+        objects can reference each other. ``ids`` is an optional list of ids
+        matching ``objs``; missing ids are generated. Returns the DBRefs.
+        """
+
+    def get_update(orig_doc, doc):
+        """Return the Mongo update document needed to write ``doc`` as a diff
+        against ``orig_doc``.
+
+        ``None`` is returned, if the full document should be saved instead.
+        """
+
+    def store_many(objs):
+        """Store several objects in the database.
+
+        All changed documents of a collection are written using a single bulk
+        operation. Objects without an OID are inserted one by one.
+        """
+
 
 class IObjectReader(zope.interface.Interface):
     """The object reader reads an object from the database."""
@@ -187,8 +249,23 @@ class IObjectReader(zope.interface.Interface):
         of.
         """
 
+    def get_cached_state(dbref):
+        """Return the state for the DBRef from the data manager's state cache.
+
+        ``None`` is returned, if no state is cached or the cached state is not
+        current anymore.
+        """
+
     def set_ghost_state(obj):
         """Convert a ghosted object to an active object by loading its state.
+
+        The attributes listed in the ``_p_mongo_deferred`` attribute of the
+        object's class are not loaded, if the document has to be read from
+        Mongo.
+        """
+
+    def set_deferred_state(obj):
+        """Load the deferred attributes of the object that are not set yet.
         """
 
     def get_ghost(coll_name, oid):
@@ -196,6 +273,51 @@ class IObjectReader(zope.interface.Interface):
         """
 
 
+class IStateCache(zope.interface.Interface):
+    """A cache of document states that survives transaction boundaries."""
+
+    hits = zope.interface.Attribute(
+        """The amount of lookups that found a state.""")
+
+    misses = zope.interface.Attribute(
+        """The amount of lookups that did not find a state.""")
+
+    def get(dbref):
+        """Return the cached document for the DBRef or ``None``."""
+
+    def put(dbref, doc):
+        """Cache the document for the DBRef.
+
+        The document must not be modified after it was put into the cache.
+        """
+
+    def invalidate(dbref):
+        """Remove the document for the DBRef from the cache."""
+
+    def clear():
+        """Remove all documents from the cache."""
+
+
+class IContainerCache(zope.interface.Interface):
+    """A per-transaction cache of the items loaded by a container.
+
+    Besides the methods listed here, the usual mapping methods are supported.
+    """
+
+    hits = zope.interface.Attribute(
+        """The amount of lookups that found an item.""")
+
+    misses = zope.interface.Attribute(
+        """The amount of lookups that did not find an item.""")
+
+    evicted = zope.interface.Attribute(
+        """Whether items were dropped from the cache to stay within its
+        bounds. A cache that evicted items never lists all items.""")
+
+    def get(key, default=None):
+        """Return the cached item for the key or the default."""
+
+
 class IMongoDataManager(persistent.interfaces.IPersistentDataManager):
     """A persistent data manager that stores data in Mongo."""
 
@@ -205,6 +327,16 @@ class IMongoDataManager(persistent.interfaces.IPersistentDataManager):
     conflict_handler = zope.interface.Attribute(
         """An ``IConflictHandler`` instance that handles all conflicts.""")
 
+    state_cache = zope.interface.Attribute(
+        """An optional ``IStateCache`` instance that is used to avoid loading
+        unchanged documents again in later transactions. Cached states are
+        only used when the conflict handler maintains a serial.""")
+
+    read_connection = zope.interface.Attribute(
+        """An optional connection, for example to a secondary, that is used
+        for queries. Collections written to within the transaction are
+        always queried using the primary connection.""")
+
     def get_collection(db_name, coll_name):
         """Return the collection for the given DB and collection names."""
 
@@ -223,6 +355,28 @@ class IMongoDataManager(persistent.interfaces.IPersistentDataManager):
         Note: The returned object is in the ghost state.
         """
 
+    def load_many(dbrefs):
+        """Load several objects from Mongo by using their DBRefs.
+
+        The documents of all objects are loaded using one query per
+        collection, so that activating the returned ghosts does not require
+        any further database access.
+        """
+
+    def prefetch(objs):
+        """Load the documents of all passed in ghosts.
+
+        Like ``load_many()``, one query per collection is issued. Objects that
+        are already active are ignored.
+        """
+
+    def load_deferred(obj):
+        """Load the deferred attributes of an active object.
+
+        This is called when a deferred attribute is accessed first and before
+        a partially loaded object is modified or removed.
+        """
+
     def flush():
         """Flush all changes to Mongo."""
 
@@ -235,6 +389,14 @@ class IMongoDataManager(persistent.interfaces.IPersistentDataManager):
         new unique id will be generated.
         """
 
+    def insert_many(objs, ids=None):
+        """Insert many new objects into Mongo at once.
+
+        Each object is written exactly once, using one bulk insert per
+        collection. If ``ids`` is provided, it is a list of ids matching
+        ``objs``. Returns the list of DBRefs.
+        """
+
     def remove(obj):
         """Remove an object from Mongo.
 
@@ -259,6 +421,23 @@ class IMongoConnectionPool(zope.interface.Interface):
         default=27017,
         required=True)
 
+    shared = zope.schema.Bool(
+        title=u'Shared',
+        description=u'Share one connection between all threads',
+        default=False,
+        required=True)
+
+    max_pool_size = zope.schema.Int(
+        title=u'Maximum Pool Size',
+        description=u'The maximum amount of sockets of a connection',
+        required=False)
+
+    created = zope.interface.Attribute(
+        'The amount of connections created by the pool.')
+
+    reused = zope.interface.Attribute(
+        'The amount of times an existing connection was returned.')
+
 
 class IMongoDataManagerProvider(zope.interface.Interface):
     """Utility to get a mongo data manager.
@@ -268,7 +447,14 @@ class IMongoDataManagerProvider(zope.interface.Interface):
     """
 
     def get():
-        """Return a mongo data manager."""
+        """Return a mongo data manager.
+
+        Data managers and connections created in a parent process are never
+        returned after forking.
+        """
+
+    def prewarm():
+        """Load the class resolution caches before forking."""
 
 
 class IMongoSpecProcessor(zope.interface.Interface):
@@ -20,12 +20,13 @@ import pymongo
 import random
 import sys
 import tempfile
+import threading
 import time
 import transaction
 import cPickle
 import cProfile
 
-from mongopersist import conflict, datamanager
+from mongopersist import conflict, datamanager, interfaces, pool, serialize
 from mongopersist.zope import container
 
 import zope.container
@@ -39,6 +40,18 @@ MULTIPLE_CLASSES = True
 PROFILE = False
 PROFILE_OUTPUT = '/tmp/cprofile'
 
+FLUSH_SCALING_SIZES = (10000, 50000, 100000)
+BUCKET_SIZE = 1000
+
+ACTIVATION_SIZES = (('1KB', 1024), ('100KB', 100*1024), ('1MB', 1024*1024))
+ACTIVATION_COUNT = 100
+
+CONTENTION_THREADS = 10
+CONTENTION_DOCUMENTS = 5
+
+POOL_THREADS = (1, 10, 50, 100)
+POOL_OPERATIONS = 100
+
 
 class People(container.AllItemsMongoContainer):
     _p_mongo_collection = 'people'
@@ -55,6 +68,7 @@ class Address(persistent.Persistent):
 class Person(persistent.Persistent, container.MongoContained):
     _p_mongo_collection = 'person'
     _p_mongo_store_type = True
+    _p_mongo_prefetch = ('address',)
 
     def __init__(self, name, age):
         self.name = name
@@ -68,6 +82,52 @@ class Person(persistent.Persistent, container.MongoContained):
 class Person2(Person):
     pass
 
+class Bucket(persistent.Persistent):
+    _p_mongo_collection = 'bucket'
+
+    def __init__(self, size):
+        self.items = [{'value': idx} for idx in xrange(size)]
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+class Shape(persistent.Persistent):
+    _p_mongo_collection = 'shape'
+
+    def __init__(self, size):
+        self.points = [Point(idx, idx) for idx in xrange(size)]
+
+class Document(persistent.Persistent):
+    _p_mongo_collection = 'document'
+
+    def __init__(self, size):
+        # Every entry takes roughly 100 bytes of BSON.
+        self.entries = [{'index': idx, 'text': u'x' * 70}
+                        for idx in xrange(size / 100)]
+
+class Counter(persistent.Persistent):
+    _p_mongo_collection = 'counter'
+    _p_mongo_merge = {'hits': 'add', 'visitors': 'union'}
+
+    def __init__(self):
+        self.hits = 0
+        self.visitors = []
+
+class Item(persistent.Persistent, container.MongoContained):
+    _p_mongo_collection = 'item'
+
+    def __init__(self, name):
+        self.name = name
+
+class Items(container.MongoContainer):
+    _p_mongo_collection = 'items'
+    _m_database = 'performance'
+    _m_collection = 'item'
+    _m_mapping_key = 'name'
+
 
 class PerformanceBase(object):
     personKlass = None
@@ -142,6 +202,21 @@ class PerformanceBase(object):
         transaction.commit()
         self.printResult('Fast Read (values)', t1, t2, peopleCnt)
 
+    def read_addresses(self, people, peopleCnt):
+        # Profile reading references of all items
+        transaction.begin()
+        t1 = time.time()
+        if PROFILE:
+            cProfile.runctx(
+                '[person.address.city for person in people.values()]',
+                globals(), locals(),
+                filename=self.profile_output+'_read_addresses')
+        else:
+            [person.address.city for person in people.values()]
+        t2 = time.time()
+        transaction.commit()
+        self.printResult('Read (address)', t1, t2, peopleCnt)
+
     def fast_read(self, people, peopleCnt):
         # Profile fast read
         transaction.begin()
@@ -231,6 +306,7 @@ class PerformanceBase(object):
         self.read_list(people, peopleCnt)
         self.read_list_values(people, peopleCnt)
         self.fast_read_values(people, peopleCnt)
+        self.read_addresses(people, peopleCnt)
         self.fast_read(people, peopleCnt)
         self.object_caching(people, peopleCnt)
 
@@ -261,11 +337,17 @@ class PerformanceMongo(PerformanceBase):
             # Profile inserts
             transaction.begin()
             t1 = time.time()
+            new = []
             for idx in xrange(options.size):
                 klass = (self.personKlass if (MULTIPLE_CLASSES and idx % 2)
                          else self.person2Klass)
-                people[None] = klass('Mr Number %.5i' % idx,
-                                     random.randint(0, 100))
+                person = klass('Mr Number %.5i' % idx, random.randint(0, 100))
+                if options.bulk_insert:
+                    new.append(person)
+                else:
+                    people[None] = person
+            if new:
+                people.add_many(new)
             transaction.commit()
             t2 = time.time()
             self.printResult('Insert', t1, t2, options.size)
@@ -274,6 +356,201 @@ class PerformanceMongo(PerformanceBase):
 
         return people
 
+    def flush_scaling(self, options):
+        # Measure how the flush scales with the amount of registered
+        # objects. Every item of a bucket is a sub-object that gets registered
+        # individually when modified.
+        conn = pymongo.Connection('localhost', 27017, tz_aware=False)
+        dm = datamanager.MongoDataManager(
+            conn,
+            default_database='performance',
+            root_database='performance')
+        for size in FLUSH_SCALING_SIZES:
+            conn['performance'].drop_collection('bucket')
+            refs = [dm.insert(Bucket(BUCKET_SIZE))
+                    for idx in xrange(size / BUCKET_SIZE)]
+            dm.reset()
+
+            transaction.begin()
+            for ref in refs:
+                for item in dm.load(ref).items:
+                    item['value'] += 1
+            t1 = time.time()
+            if PROFILE:
+                cProfile.runctx(
+                    'transaction.commit()', globals(), locals(),
+                    filename=self.profile_output+'_flush_%i' % size)
+            else:
+                transaction.commit()
+            t2 = time.time()
+            self.printResult(
+                'Flush (%i registered)' % size, t1, t2, size)
+
+    def serialization(self, options):
+        # Measure converting objects with many non-persistent sub-objects to
+        # Mongo states and back, without accessing Mongo.
+        writer = serialize.ObjectWriter(None)
+        reader = serialize.ObjectReader(None)
+        shapes = [Shape(10) for idx in xrange(options.size)]
+        t1 = time.time()
+        states = [writer.get_state(shape.__getstate__(), shape)
+                  for shape in shapes]
+        t2 = time.time()
+        self.printResult('Serialize', t1, t2, options.size)
+
+        t1 = time.time()
+        [reader.get_object(state, None) for state in states]
+        t2 = time.time()
+        self.printResult('Deserialize', t1, t2, options.size)
+
+    def activation(self, options):
+        # Measure how long it takes to activate documents of various sizes,
+        # not including the time to load them from Mongo.
+        conn = pymongo.Connection('localhost', 27017, tz_aware=False)
+        dm = datamanager.MongoDataManager(
+            conn,
+            default_database='performance',
+            root_database='performance')
+        conn['performance'].drop_collection('document')
+        for label, size in ACTIVATION_SIZES:
+            ref = dm.insert(Document(size))
+            doc = conn[ref.database][ref.collection].find_one(ref.id)
+            t1 = time.time()
+            for idx in xrange(ACTIVATION_COUNT):
+                dm.reset()
+                dm._reader.set_ghost_state(dm.load(ref), doc)
+            t2 = time.time()
+            self.printResult(
+                'Activation (%s)' % label, t1, t2, ACTIVATION_COUNT)
+
+    def contention(self, options):
+        # Measure how many transactions have to be retried when many threads
+        # modify the same few documents. Conflicts can only be detected with
+        # acknowledged writes.
+        conn = pymongo.Connection('localhost', 27017, tz_aware=False, w=1)
+        handlers = (
+            ('Serial', conflict.SimpleSerialConflictHandler),
+            ('Merging', conflict.ResolvingSerialConflictHandler),
+            ('Merging CAS', conflict.CompareAndSwapConflictHandler))
+        for label, factory in handlers:
+            conn['performance'].drop_collection('counter')
+            dm = datamanager.MongoDataManager(
+                conn,
+                default_database='performance',
+                root_database='performance',
+                conflict_handler_factory=factory)
+            refs = [dm.insert(Counter())
+                    for idx in xrange(CONTENTION_DOCUMENTS)]
+            dm.reset()
+
+            lock = threading.Lock()
+            stats = {'commits': 0, 'retries': 0}
+            def modify(thread_idx):
+                dm = datamanager.MongoDataManager(
+                    conn,
+                    default_database='performance',
+                    root_database='performance',
+                    conflict_handler_factory=factory)
+                for idx in xrange(options.size / CONTENTION_THREADS):
+                    ref = random.choice(refs)
+                    while True:
+                        transaction.begin()
+                        counter = dm.load(ref)
+                        counter.hits += 1
+                        counter.visitors.append(thread_idx)
+                        try:
+                            transaction.commit()
+                        except interfaces.ConflictError:
+                            transaction.abort()
+                            with lock:
+                                stats['retries'] += 1
+                        else:
+                            with lock:
+                                stats['commits'] += 1
+                            break
+
+            threads = [threading.Thread(target=modify, args=(idx,))
+                       for idx in xrange(CONTENTION_THREADS)]
+            t1 = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            t2 = time.time()
+            self.printResult(
+                'Contention (%s)' % label, t1, t2, stats['commits'])
+            print '%-25s %.1f%%' % (
+                'Retry rate:',
+                100.0 * stats['retries'] / max(stats['commits'], 1))
+
+            # Every committed transaction must be reflected in the counters,
+            # otherwise updates were lost.
+            expected = CONTENTION_THREADS * (options.size / CONTENTION_THREADS)
+            hits = sum(doc['hits']
+                       for doc in conn['performance']['counter'].find())
+            if hits != expected:
+                raise AssertionError(
+                    'Lost updates (%s): %i hits, %i expected' % (
+                        label, hits, expected))
+
+    def writes_per_insert(self, options):
+        # Count the document writes Mongo receives for every item added to a
+        # container, when adding the items one by one and all at once.
+        conn = pymongo.Connection('localhost', 27017, tz_aware=False)
+        def get_writes():
+            counters = conn['admin'].command('serverStatus')['opcounters']
+            return counters['insert'] + counters['update']
+        for label in ('setitem', 'add_many'):
+            conn['performance'].drop_collection('item')
+            dm = datamanager.MongoDataManager(
+                conn,
+                default_database='performance',
+                root_database='performance')
+            dm.root['items'] = Items()
+            transaction.commit()
+            items = dm.root['items']
+            new = [Item('Item %.5i' % idx) for idx in xrange(options.size)]
+            writes = get_writes()
+            t1 = time.time()
+            if label == 'add_many':
+                items.add_many(new)
+            else:
+                for item in new:
+                    items[None] = item
+            transaction.commit()
+            t2 = time.time()
+            self.printResult('Insert (%s)' % label, t1, t2, options.size)
+            print '%-25s %.2f' % (
+                'Writes per insert:',
+                float(get_writes() - writes) / options.size)
+
+    def pool_scaling(self, options):
+        # Measure how per-thread and shared connections scale with the amount
+        # of threads accessing Mongo.
+        for shared in (False, True):
+            for count in POOL_THREADS:
+                mpool = pool.MongoConnectionPool(
+                    logLevel=0, tz_aware=False, w=1, shared=shared)
+                def read():
+                    coll = mpool.connection['performance']['person']
+                    for idx in xrange(POOL_OPERATIONS):
+                        coll.find_one()
+                threads = [threading.Thread(target=read)
+                           for idx in xrange(count)]
+                t1 = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                t2 = time.time()
+                self.printResult(
+                    '%s (%i threads)' % (
+                        'Shared' if shared else 'Per thread', count),
+                    t1, t2, count * POOL_OPERATIONS)
+                print '%-25s %i' % ('Connections:', mpool.created)
+                if shared:
+                    mpool.disconnect()
+
 
 class PeopleZ(zope.container.btree.BTreeContainer):
     pass
@@ -366,6 +643,41 @@ parser.add_option(
     dest='delete', default=True,
     help='A flag, when set, causes the data not to be deleted at the end.')
 
+parser.add_option(
+    '--bulk-insert', action='store_true',
+    dest='bulk_insert', default=False,
+    help='A flag, when set, inserts the people using a single add_many().')
+
+parser.add_option(
+    '--flush-scaling', action='store_true',
+    dest='flush_scaling', default=False,
+    help='A flag, when set, measures flushing many registered objects.')
+
+parser.add_option(
+    '--serialization', action='store_true',
+    dest='serialization', default=False,
+    help='A flag, when set, measures serializing non-persistent objects.')
+
+parser.add_option(
+    '--activation', action='store_true',
+    dest='activation', default=False,
+    help='A flag, when set, measures activating documents of various sizes.')
+
+parser.add_option(
+    '--contention', action='store_true',
+    dest='contention', default=False,
+    help='A flag, when set, measures conflicts of concurrent transactions.')
+
+parser.add_option(
+    '--writes-per-insert', action='store_true',
+    dest='writes_per_insert', default=False,
+    help='A flag, when set, counts the writes needed to add container items.')
+
+parser.add_option(
+    '--pool-scaling', action='store_true',
+    dest='pool_scaling', default=False,
+    help='A flag, when set, measures connection pools with many threads.')
+
 
 def main(args=None):
     # Parse command line options.
@@ -377,3 +689,27 @@ def main(args=None):
     PerformanceMongo().run_basic_crud(options)
     print 'ZODB  ---------------'
     PerformanceZODB().run_basic_crud(options)
+
+    if options.flush_scaling:
+        print 'MONGO FLUSH ---------'
+        PerformanceMongo().flush_scaling(options)
+
+    if options.serialization:
+        print 'MONGO SERIALIZATION -'
+        PerformanceMongo().serialization(options)
+
+    if options.activation:
+        print 'MONGO ACTIVATION ----'
+        PerformanceMongo().activation(options)
+
+    if options.contention:
+        print 'MONGO CONTENTION ----'
+        PerformanceMongo().contention(options)
+
+    if options.writes_per_insert:
+        print 'MONGO WRITES --------'
+        PerformanceMongo().writes_per_insert(options)
+
+    if options.pool_scaling:
+        print 'MONGO POOL ----------'
+        PerformanceMongo().pool_scaling(options)
@@ -14,6 +14,7 @@
 """Thread-aware Mongo Connection Pool"""
 from __future__ import absolute_import
 import logging
+import os
 import threading
 import pymongo
 import zope.interface
@@ -28,27 +29,41 @@ class MongoConnectionPool(object):
     MongoConnectionPool is a global named utility, knows how to setup a
     thread (safe) shared mongodb connection instance.
 
-    Note: pymongo offers connection pooling which we do not need since we use
-    one connection per thread
+    By default one connection is created per thread, in which case the
+    connection pooling of pymongo is not needed. In shared mode, all threads
+    use a single connection per host, port and options, which pools its
+    sockets itself. ``max_pool_size`` then limits the amount of sockets.
     """
     zope.interface.implements(interfaces.IMongoConnectionPool)
 
     _mongoConnectionFactory = pymongo.MongoClient
 
     def __init__(self, host='localhost', port=27017, logLevel=20,
-                 tz_aware=True, w=3, j=True, connectionFactory=None):
+                 tz_aware=True, w=3, j=True, connectionFactory=None,
+                 shared=False, max_pool_size=None):
         self.host = host
         self.port = port
-        self.key = 'mongopersist-%s-%s' %(self.host, self.port)
         self.tz_aware = tz_aware
         if connectionFactory is not None:
             self._mongoConnectionFactory = connectionFactory
         self.logLevel = logLevel
         self.w = w
         self.j = j
+        self.shared = shared
+        self.max_pool_size = max_pool_size
+        if shared:
+            self.key = 'mongopersist-%s-%s-%s-%s-%s-%s' %(
+                self.host, self.port, tz_aware, w, j, max_pool_size)
+        else:
+            self.key = 'mongopersist-%s-%s' %(self.host, self.port)
+        # Statistics about how often connections are created and reused.
+        self.created = 0
+        self.reused = 0
 
     @property
     def storage(self):
+        if self.shared:
+            return SHARED
         return LOCAL.__dict__
 
     def disconnect(self):
@@ -57,32 +72,86 @@ class MongoConnectionPool(object):
             conn.disconnect()
         self.storage[self.key] = None
 
+    def _create_connection(self):
+        kwargs = {}
+        if self.max_pool_size is not None:
+            kwargs['max_pool_size'] = self.max_pool_size
+        conn = self._mongoConnectionFactory(
+            self.host, self.port, tz_aware=self.tz_aware,
+            w=self.w, j=self.j, **kwargs)
+        self.created += 1
+        if self.logLevel:
+            log.log(self.logLevel, "Create connection for %s:%s" % (
+                self.host, self.port))
+        return conn
+
     @property
     def connection(self):
+        check_pid()
         conn = self.storage.get(self.key, None)
-        if conn is None:
-            self.storage[self.key] = conn = self._mongoConnectionFactory(
-                self.host, self.port, tz_aware=self.tz_aware,
-                w=self.w, j=self.j)
-            if self.logLevel:
-                log.log(self.logLevel, "Create connection for %s:%s" % (
-                    self.host, self.port))
-
+        if conn is not None:
+            self.reused += 1
+            return conn
+        if not self.shared:
+            self.storage[self.key] = conn = self._create_connection()
+            return conn
+        with SHARED_LOCK:
+            # Another thread might have created the connection in the
+            # meantime.
+            conn = SHARED.get(self.key, None)
+            if conn is None:
+                SHARED[self.key] = conn = self._create_connection()
+            else:
+                self.reused += 1
         return conn
 
 
 LOCAL = threading.local()
+# Connections shared by all threads.
+SHARED = {}
+SHARED_LOCK = threading.Lock()
+# The process the connections and data managers were created in.
+PID = os.getpid()
+
+def check_pid():
+    """Forget connections and data managers inherited from a parent process.
+
+    Sockets must not be shared between processes, so a child process has to
+    create its own connections after forking.
+    """
+    global PID, SHARED_LOCK
+    pid = os.getpid()
+    if pid == PID:
+        return
+    PID = pid
+    # The lock might have been held by another thread while forking.
+    SHARED_LOCK = threading.Lock()
+    SHARED.clear()
+    # Only the forking thread exists in the child process.
+    LOCAL.__dict__.clear()
 
 class MongoDataManagerProvider(object):
     zope.interface.implements(interfaces.IMongoDataManagerProvider)
 
     def __init__(self, host='localhost', port=27017,
                  logLevel=20, tz_aware=True, w=1, j=True,
+                 shared=False, max_pool_size=None,
                  **dm_kwargs):
-        self.pool = MongoConnectionPool(host, port, logLevel, tz_aware, w, j)
+        self.pool = MongoConnectionPool(
+            host, port, logLevel, tz_aware, w, j,
+            shared=shared, max_pool_size=max_pool_size)
         self.dm_kwargs = dm_kwargs
 
+    def prewarm(self):
+        """Load the class resolution caches.
+
+        Call this in the parent process of a prefork server, so that the
+        children start with warm caches.
+        """
+        self.get()._reader.warm_caches()
+
     def get(self):
+        check_pid()
         try:
             dm = LOCAL.data_manager
         except AttributeError:
@@ -13,14 +13,17 @@
 ##############################################################################
 """Object Serialization for Mongo/BSON"""
 from __future__ import absolute_import
-import copy
 import copy_reg
+import functools
+import re
+import sys
 
 import bson.dbref
 import bson.objectid
 import persistent.interfaces
 import persistent.dict
 import persistent.list
+import pymongo.collection
 import bson.dbref
 import bson.binary
 import repoze.lru
@@ -32,18 +35,187 @@ from mongopersist import interfaces
 
 IGNORE_IDENTICAL_DOCUMENTS = True
 ALWAYS_READ_FULL_DOC = True
+WRITE_DOCUMENT_DIFFS = False
+WRITE_NESTED_DIFFS = False
+LAZY_SUB_DOCUMENTS = False
+# Older versions of pymongo do not provide the bulk API. Their collections
+# return a sub-collection for any unknown attribute, so the class is checked.
+BULK_API = hasattr(
+    pymongo.collection.Collection, 'initialize_unordered_bulk_op')
 
-SERIALIZERS = []
+
+class SerializerList(list):
+    """The list of registered object serializers.
+
+    Looking up the serializer for an object or state is cached. The cache is
+    keyed by the object type when writing and by the `_py_type` field of the
+    state when reading, so `can_write()` and `can_read()` must only depend on
+    those. Any modification of the list clears the cache.
+    """
+
+    def __init__(self, *args):
+        super(SerializerList, self).__init__(*args)
+        self._changed()
+
+    def _changed(self):
+        self._write_cache = {}
+        self._read_cache = {}
+
+    def get_writer(self, obj):
+        # The type of all instances of old-style classes is InstanceType, so
+        # the class is used instead.
+        klass = obj.__class__
+        try:
+            return self._write_cache[klass]
+        except KeyError:
+            pass
+        for serializer in self:
+            if serializer.can_write(obj):
+                break
+        else:
+            serializer = None
+        self._write_cache[klass] = serializer
+        return serializer
+
+    def get_reader(self, state):
+        if isinstance(state, dict):
+            key = (dict, state.get('_py_type'))
+        else:
+            key = (type(state), None)
+        try:
+            return self._read_cache[key]
+        except KeyError:
+            pass
+        for serializer in self:
+            if serializer.can_read(state):
+                break
+        else:
+            serializer = None
+        self._read_cache[key] = serializer
+        return serializer
+
+    def append(self, serializer):
+        super(SerializerList, self).append(serializer)
+        self._changed()
+
+    def extend(self, serializers):
+        super(SerializerList, self).extend(serializers)
+        self._changed()
+
+    def insert(self, index, serializer):
+        super(SerializerList, self).insert(index, serializer)
+        self._changed()
+
+    def remove(self, serializer):
+        super(SerializerList, self).remove(serializer)
+        self._changed()
+
+    def pop(self, *args):
+        result = super(SerializerList, self).pop(*args)
+        self._changed()
+        return result
+
+    def sort(self, *args, **kw):
+        super(SerializerList, self).sort(*args, **kw)
+        self._changed()
+
+    def reverse(self):
+        super(SerializerList, self).reverse()
+        self._changed()
+
+    def __setitem__(self, index, serializer):
+        super(SerializerList, self).__setitem__(index, serializer)
+        self._changed()
+
+    def __delitem__(self, index):
+        super(SerializerList, self).__delitem__(index)
+        self._changed()
+
+    def __setslice__(self, i, j, serializers):
+        super(SerializerList, self).__setslice__(i, j, serializers)
+        self._changed()
+
+    def __delslice__(self, i, j):
+        super(SerializerList, self).__delslice__(i, j)
+        self._changed()
+
+    def __iadd__(self, serializers):
+        result = super(SerializerList, self).__iadd__(serializers)
+        self._changed()
+        return result
+
+    def __imul__(self, n):
+        result = super(SerializerList, self).__imul__(n)
+        self._changed()
+        return result
+
+
+SERIALIZERS = SerializerList()
 OID_CLASS_LRU = repoze.lru.LRUCache(20000)
 COLLECTIONS_WITH_TYPE = set()
 AVAILABLE_NAME_MAPPINGS = set()
 PATH_RESOLVE_CACHE = {}
+REDUCE_PLAN_CACHE = {}
+LOAD_PLAN_CACHE = {}
+DUPLICATE_OBJECTID_RE = re.compile(r"dup key: \{ : ObjectId\('([0-9a-f]{24})'\)")
 
 
 def get_dotted_name(obj):
     return obj.__module__ + '.' + obj.__name__
 
 
+def _collect_document_diff(orig_doc, new_doc, prefix, nested, to_set, to_unset):
+    for name, value in new_doc.iteritems():
+        path = prefix + name
+        if name not in orig_doc:
+            to_set[path] = value
+            continue
+        orig_value = orig_doc[name]
+        if nested and type(value) is dict and type(orig_value) is dict:
+            # Sub-document keys are always valid field names, since dicts
+            # with other keys are stored as `dict_data` lists.
+            _collect_document_diff(
+                orig_value, value, path+'.', nested, to_set, to_unset)
+        elif orig_value != value:
+            to_set[path] = value
+    for name in orig_doc:
+        if name not in new_doc:
+            to_unset[prefix + name] = True
+
+
+def collect_references(state, refs):
+    """Add all DBRefs found in the Mongo state to the `refs` list."""
+    if isinstance(state, bson.dbref.DBRef):
+        refs.append(state)
+    elif isinstance(state, dict):
+        for value in state.itervalues():
+            collect_references(value, refs)
+    elif isinstance(state, (tuple, list)):
+        for value in state:
+            collect_references(value, refs)
+
+
+def get_document_diff(orig_doc, new_doc, nested=False):
+    """Compute a Mongo update document that turns `orig_doc` into `new_doc`.
+
+    Only changed fields are included using the `$set` and `$unset`
+    operators. If `nested` is true, sub-documents are compared field by field
+    as well. An empty dictionary is returned if both documents are the same.
+    """
+    to_set = {}
+    to_unset = {}
+    _collect_document_diff(orig_doc, new_doc, '', nested, to_set, to_unset)
+    # The id of a document never changes.
+    to_set.pop('_id', None)
+    to_unset.pop('_id', None)
+    update = {}
+    if to_set:
+        update['$set'] = to_set
+    if to_unset:
+        update['$unset'] = to_unset
+    return update
+
+
 class PersistentDict(persistent.dict.PersistentDict):
     _p_mongo_sub_object = True
 
@@ -77,6 +249,72 @@ class PersistentList(persistent.list.PersistentList):
     _p_mongo_sub_object = True
 
 
+class LazyPersistentDict(PersistentDict):
+    """A persistent dictionary converting its state on first access.
+
+    Only the direct children are converted; nested containers are lazy
+    themselves. The data is stored directly in ``__dict__``, so that the
+    conversion does not mark the object as changed.
+    """
+
+    def __init__(self, reader, state, doc_obj):
+        self.__dict__['_v_mongo_lazy'] = (reader, state, doc_obj)
+
+    def __getattr__(self, name):
+        if name != 'data' or '_v_mongo_lazy' not in self.__dict__:
+            raise AttributeError(name)
+        reader, state, doc_obj = self.__dict__.pop('_v_mongo_lazy')
+        # Handle non-string key dicts.
+        if 'dict_data' in state:
+            items = state['dict_data']
+        else:
+            items = state.items()
+        data = self.__dict__['data'] = dict(
+            [(reader.get_object(name, doc_obj),
+              reader.get_object(value, doc_obj))
+             for name, value in items])
+        return data
+
+    def __getstate__(self):
+        self.data
+        return super(LazyPersistentDict, self).__getstate__()
+
+
+class LazyPersistentList(PersistentList):
+    """A persistent list converting its state on first access."""
+
+    def __init__(self, reader, state, doc_obj):
+        self.__dict__['_v_mongo_lazy'] = (reader, state, doc_obj)
+
+    def __getattr__(self, name):
+        if name != 'data' or '_v_mongo_lazy' not in self.__dict__:
+            raise AttributeError(name)
+        reader, state, doc_obj = self.__dict__.pop('_v_mongo_lazy')
+        data = self.__dict__['data'] = [
+            reader.get_object(value, doc_obj) for value in state]
+        return data
+
+    def __getstate__(self):
+        self.data
+        return super(LazyPersistentList, self).__getstate__()
+
+
+class DeferredAttributesMixin(object):
+    """Load the attributes listed in ``_p_mongo_deferred`` on first access.
+
+    This mix-in must precede the persistent base class. Deferred attributes
+    must not have a class-level default.
+    """
+    _p_mongo_deferred = ()
+
+    def __getattr__(self, name):
+        if name in self._p_mongo_deferred and self._p_jar is not None:
+            self._p_jar.load_deferred(self)
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(name)
+
+
 class ObjectSerializer(object):
     zope.interface.implements(interfaces.IObjectSerializer)
 
@@ -141,6 +379,42 @@ class ObjectWriter(object):
         AVAILABLE_NAME_MAPPINGS.add(map_hash)
         return db_name, coll_name
 
+    def get_reduce_plan(self, obj, reduced):
+        """Return the meta-data state and a state getter for the object's class.
+
+        The plan is computed once per class from the reduced object and
+        allows to skip reducing further objects of the same class. ``None``
+        is returned, if objects of the class must always be reduced.
+        """
+        klass = obj.__class__
+        try:
+            return REDUCE_PLAN_CACHE[klass]
+        except KeyError:
+            pass
+        plan = None
+        # Only classes using the default reduce implementations produce
+        # predictable results.
+        if (type(obj) is klass and
+            klass not in copy_reg.dispatch_table and
+            not isinstance(reduced, str) and
+            klass.__reduce_ex__ is object.__reduce_ex__):
+            factory, args = reduced[:2]
+            if (factory == copy_reg._reconstructor and
+                args == (klass, object, None) and
+                klass.__reduce__ is object.__reduce__ and
+                not hasattr(klass, '__getstate__') and
+                not hasattr(klass, '__slots__')):
+                plan = ({'_py_type': get_dotted_name(klass)},
+                        lambda obj: obj.__dict__)
+            elif (factory == copy_reg.__newobj__ and
+                  args == (klass,) and
+                  klass.__reduce__ is persistent.Persistent.__reduce__ and
+                  not hasattr(klass, '__getnewargs__')):
+                plan = ({'_py_persistent_type': get_dotted_name(klass)},
+                        lambda obj: obj.__getstate__())
+        REDUCE_PLAN_CACHE[klass] = plan
+        return plan
+
     def get_non_persistent_state(self, obj, seen):
         __traceback_info__ = obj, type(obj)
         # XXX: Look at the pickle library how to properly handle all types and
@@ -154,6 +428,15 @@ class ObjectWriter(object):
         if not (type(obj) in interfaces.REFERENCE_SAFE_TYPES or
                 getattr(obj, '_m_reference_safe', False)):
             seen.append(id(obj))
+        # If we have reduced an object of this class before, we know how the
+        # output looks like without reducing the object again.
+        plan = REDUCE_PLAN_CACHE.get(obj.__class__)
+        if plan is not None:
+            meta_state, get_obj_state = plan
+            state = meta_state.copy()
+            for name, value in get_obj_state(obj).items():
+                state[name] = self.get_state(value, obj, seen)
+            return state
         # Get the state of the object. Only pickable objects can be reduced.
         reduce_fn = copy_reg.dispatch_table.get(type(obj))
         if reduce_fn is not None:
@@ -167,6 +450,8 @@ class ObjectWriter(object):
             # When the reduced state is just a string it represents a name in
             # a module. The module will be extrated from __module__.
             return {'_py_constant': obj.__module__+'.'+reduced}
+        # Remember how objects of this class reduce.
+        self.get_reduce_plan(obj, reduced)
         if len(reduced) == 2:
             factory, args = reduced
             obj_state = {}
@@ -227,9 +512,9 @@ class ObjectWriter(object):
         # Some objects might not naturally serialize well and create a very
         # ugly Mongo entry. Thus, we allow custom serializers to be
         # registered, which can encode/decode different types of objects.
-        for serializer in SERIALIZERS:
-            if serializer.can_write(obj):
-                return serializer.write(obj)
+        serializer = SERIALIZERS.get_writer(obj)
+        if serializer is not None:
+            return serializer.write(obj)
 
         if isinstance(obj, (type, types.ClassType)):
             # We frequently store class and function paths as meta-data, so we
@@ -286,8 +571,17 @@ class ObjectWriter(object):
 
         return self.get_non_persistent_state(obj, seen)
 
+    def _get_complete_state(self, obj):
+        state = obj.__getstate__()
+        # Writing a partially loaded object would remove its deferred fields
+        # from the document, so they have to be loaded first.
+        if obj._p_oid in self._jar._deferred_objects:
+            self._jar.load_deferred(obj)
+            state = obj.__getstate__()
+        return state
+
     def get_full_state(self, obj):
-        doc = self.get_state(obj.__getstate__(), obj)
+        doc = self.get_state(self._get_complete_state(obj), obj)
         # Add a persistent type info, if necessary.
         if getattr(obj, '_p_mongo_store_type', False):
             doc['_py_persistent_type'] = get_dotted_name(obj.__class__)
@@ -315,7 +609,7 @@ class ObjectWriter(object):
         else:
             # XXX: Handle newargs; see ZODB.serialize.ObjectWriter.serialize
             # Go through each attribute and search for persistent references.
-            doc = self.get_state(obj.__getstate__(), obj)
+            doc = self.get_state(self._get_complete_state(obj), obj)
 
         if getattr(obj, '_p_mongo_store_type', False):
             doc['_py_persistent_type'] = get_dotted_name(obj.__class__)
@@ -344,12 +638,22 @@ class ObjectWriter(object):
             orig_doc = self._jar._latest_states.get(obj._p_oid)
             if (not IGNORE_IDENTICAL_DOCUMENTS or
                 not self._jar.conflict_handler.is_same(obj, orig_doc, doc)):
-                coll.save(doc)
+                if getattr(self._jar.conflict_handler,
+                           'compare_and_swap', False):
+                    doc = self._store_checked(coll, obj, orig_doc, doc)
+                else:
+                    update = self.get_update(orig_doc, doc)
+                    if update is None:
+                        coll.save(doc)
+                    elif update:
+                        coll.update({'_id': doc['_id']}, update)
                 stored = True
 
         if stored:
             # Make sure that the doc is added to the latest states.
             self._jar._latest_states[obj._p_oid] = doc
+            if self._jar.state_cache is not None:
+                self._jar.state_cache.invalidate(obj._p_oid)
 
             # A hook, so that the conflict handler can modify the object or state
             # document after an object was stored.
@@ -357,6 +661,190 @@ class ObjectWriter(object):
 
         return obj._p_oid
 
+    def insert_many(self, objs, ids=None):
+        # The ids of the documents actually written, keyed by collection.
+        written = {}
+        try:
+            return self._insert_many(objs, ids, written)
+        except:
+            exc_info = sys.exc_info()
+            self._undo_insert_many(objs, written)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _insert_many(self, objs, ids, written):
+        if ids is None:
+            ids = [None] * len(objs)
+        # Assign all ids first, so that the new objects can reference each
+        # other without being stored by reference only and written again.
+        for obj, id in zip(objs, ids):
+            db_name, coll_name = self.get_collection_name(obj)
+            if id is None:
+                id = bson.objectid.ObjectId()
+            obj._p_jar = self._jar
+            obj._p_oid = bson.dbref.DBRef(coll_name, id, db_name)
+            self._jar._object_cache[hash(obj._p_oid)] = obj
+
+        pending = {}
+        for obj in objs:
+            __traceback_info__ = obj
+            doc = self.get_state(obj.__getstate__(), obj)
+            if getattr(obj, '_p_mongo_store_type', False):
+                doc['_py_persistent_type'] = get_dotted_name(obj.__class__)
+            self._jar.conflict_handler.on_before_store(obj, doc)
+            doc['_id'] = obj._p_oid.id
+            pending.setdefault(
+                (obj._p_oid.database, obj._p_oid.collection), []).append(
+                (obj, doc))
+
+        # Now insert all documents of a collection in one go.
+        for (db_name, coll_name), items in pending.items():
+            coll = self._jar.get_collection(db_name, coll_name)
+            docs = [doc for obj, doc in items]
+            try:
+                coll.insert(docs)
+            except:
+                count = self._get_inserted_count(sys.exc_info()[1], docs)
+                written[(db_name, coll_name)] = [
+                    doc['_id'] for doc in docs[:count]]
+                raise
+            written[(db_name, coll_name)] = [doc['_id'] for doc in docs]
+            for obj, doc in items:
+                self._jar._latest_states[obj._p_oid] = doc
+                self._jar.conflict_handler.on_after_store(obj, doc)
+
+        return [obj._p_oid for obj in objs]
+
+    def _get_inserted_count(self, error, docs):
+        # Newer servers report how many documents were inserted.
+        details = getattr(error, 'details', None) or {}
+        if 'nInserted' in details:
+            return details['nInserted']
+        # Otherwise only the duplicate key is known. Since inserting stops at
+        # the first failing document, all documents before it were written.
+        match = DUPLICATE_OBJECTID_RE.search(str(error))
+        if match is not None:
+            for idx, doc in enumerate(docs):
+                if unicode(doc['_id']) == match.group(1):
+                    return idx
+        # Rather leave documents behind than removing documents that were
+        # not written by us.
+        return 0
+
+    def _undo_insert_many(self, objs, written):
+        # Remove the documents that were written before the failure, and
+        # forget the assigned ids, so that the objects can be inserted again.
+        for (db_name, coll_name), ids in written.items():
+            if ids:
+                coll = self._jar.get_collection(db_name, coll_name)
+                coll.remove({'_id': {'$in': ids}})
+        for obj in objs:
+            if obj._p_oid is None:
+                continue
+            self._jar._object_cache.pop(hash(obj._p_oid), None)
+            self._jar._latest_states.pop(obj._p_oid, None)
+            obj._p_oid = None
+            obj._p_jar = None
+
+    def get_update(self, orig_doc, doc):
+        """Return the update document to write `doc` as a diff.
+
+        ``None`` is returned, if the full document has to be saved.
+        """
+        if not WRITE_DOCUMENT_DIFFS or orig_doc is None:
+            return None
+        return get_document_diff(orig_doc, doc, WRITE_NESTED_DIFFS)
+
+    def _store_checked(self, coll, obj, orig_doc, doc):
+        # Write the document only if its serial did not change since it was
+        # loaded. This makes conflict detection atomic and does not require
+        # reading the document first.
+        handler = self._jar.conflict_handler
+        while True:
+            update = self.get_update(orig_doc, doc)
+            if update is None:
+                update = doc
+            elif not update:
+                return doc
+            result = coll.update(handler.get_store_spec(obj), update)
+            # Without acknowledged writes conflicts cannot be detected.
+            if result is None:
+                raise ValueError(
+                    'Compare-and-swap conflict detection requires '
+                    'acknowledged writes.', obj)
+            if result.get('n'):
+                return doc
+            # The conflict handler either resolves the conflict by updating
+            # the object or raises a conflict error.
+            handler.resolve_store_conflict(obj, coll)
+            # The resolved state is always written completely.
+            orig_doc = None
+            doc = self.get_full_state(obj)
+
+    def _bulk_save(self, coll, docs):
+        bulk = None
+        if BULK_API:
+            bulk = coll.initialize_unordered_bulk_op()
+        has_ops = False
+        for orig_doc, doc in docs:
+            update = self.get_update(orig_doc, doc)
+            if bulk is None:
+                # Without the bulk API, we have to fall back to writing one
+                # document at a time.
+                if update is None:
+                    coll.save(doc)
+                elif update:
+                    coll.update({'_id': doc['_id']}, update)
+            elif update is None:
+                bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+                has_ops = True
+            elif update:
+                bulk.find({'_id': doc['_id']}).update_one(update)
+                has_ops = True
+        if has_ops:
+            bulk.execute()
+
+    def store_many(self, objs):
+        # Objects that are not in the database yet need their id right away,
+        # so they are inserted one by one.
+        pending = {}
+        for obj in objs:
+            __traceback_info__ = obj
+            if obj._p_oid is None:
+                self.store(obj)
+                continue
+            db_name, coll_name = self.get_collection_name(obj)
+            doc = self.get_full_state(obj)
+            # Just like in store(), only write a new version of the document,
+            # if it is different.
+            orig_doc = self._jar._latest_states.get(obj._p_oid)
+            if (IGNORE_IDENTICAL_DOCUMENTS and
+                self._jar.conflict_handler.is_same(obj, orig_doc, doc)):
+                continue
+            pending.setdefault((db_name, coll_name), []).append(
+                (obj, orig_doc, doc))
+
+        # Now write all changed documents of a collection in one go.
+        compare_and_swap = getattr(
+            self._jar.conflict_handler, 'compare_and_swap', False)
+        for (db_name, coll_name), items in pending.items():
+            coll = self._jar.get_collection(db_name, coll_name)
+            if compare_and_swap:
+                # The result of a bulk operation does not tell which
+                # documents did not match, so every document is written on
+                # its own.
+                items = [
+                    (obj, orig_doc,
+                     self._store_checked(coll, obj, orig_doc, doc))
+                    for obj, orig_doc, doc in items]
+            else:
+                self._bulk_save(
+                    coll, [(orig_doc, doc) for obj, orig_doc, doc in items])
+            for obj, orig_doc, doc in items:
+                self._jar._latest_states[obj._p_oid] = doc
+                if self._jar.state_cache is not None:
+                    self._jar.state_cache.invalidate(obj._p_oid)
+                self._jar.conflict_handler.on_after_store(obj, doc)
+
 
 class ObjectReader(object):
     zope.interface.implements(interfaces.IObjectReader)
@@ -384,6 +872,25 @@ class ObjectReader(object):
             raise ImportError(path)
         return klass
 
+    def warm_caches(self):
+        """Load the name map into the module-level caches.
+
+        This is useful to do in a parent process before forking, so that the
+        children do not have to look up classes and name mappings again.
+        """
+        db = self._jar._conn[self._jar.default_database]
+        for map in db[self._jar.name_map_collection].find():
+            try:
+                klass = self.simple_resolve(map['path'])
+            except ImportError:
+                continue
+            if map['doc_has_type']:
+                # Just as in get_collection_name(), make sure that classes
+                # sharing a collection store their type.
+                klass._p_mongo_store_type = True
+            AVAILABLE_NAME_MAPPINGS.add(
+                (map['database'], map['collection'], map['path']))
+
     def resolve(self, dbref):
         __traceback_info__ = dbref
         # 1. Check the global oid-based lookup cache. Use the hash of the id,
@@ -485,22 +992,52 @@ class ObjectReader(object):
             OID_CLASS_LRU.put(hash(dbref), klass)
             return klass
 
-    def get_non_persistent_object(self, state, obj):
-        if '_py_constant' in state:
-            return self.simple_resolve(state.pop('_py_constant'))
+    def get_load_plan(self, state):
+        """Return a factory and the meta-data fields for the state's class.
+
+        Like the reduce plans of the writer, the plan is computed once per
+        ``_py_type`` or ``_py_persistent_type`` value. ``None`` is returned
+        for states whose objects are created by a factory.
+        """
         if '_py_type' in state:
-            # Handle the simplified case.
-            klass = self.simple_resolve(state.pop('_py_type'))
-            sub_obj = copy_reg._reconstructor(klass, object, None)
+            key = ('_py_type', state['_py_type'])
         elif '_py_persistent_type' in state:
+            key = ('_py_persistent_type', state['_py_persistent_type'])
+        else:
+            return None
+        try:
+            return LOAD_PLAN_CACHE[key]
+        except KeyError:
+            pass
+        klass = self.simple_resolve(key[1])
+        if key[0] == '_py_type':
+            # Handle the simplified case.
+            factory = functools.partial(
+                copy_reg._reconstructor, klass, object, None)
+        else:
             # Another simple case for persistent objects that do not want
             # their own document.
-            klass = self.simple_resolve(state.pop('_py_persistent_type'))
-            sub_obj = copy_reg.__newobj__(klass)
+            factory = functools.partial(copy_reg.__newobj__, klass)
+        plan = LOAD_PLAN_CACHE[key] = (factory, key[:1])
+        return plan
+
+    def get_non_persistent_object(self, state, obj):
+        # The state is never modified, since it is part of the document that
+        # is kept as the original state. Instead, the meta-data fields that
+        # were used are skipped.
+        if '_py_constant' in state:
+            return self.simple_resolve(state['_py_constant'])
+        plan = self.get_load_plan(state)
+        if plan is not None:
+            factory, meta_fields = plan
+            sub_obj = factory()
         else:
-            factory = self.simple_resolve(state.pop('_py_factory'))
-            factory_args = self.get_object(state.pop('_py_factory_args'), obj)
+            factory = self.simple_resolve(state['_py_factory'])
+            factory_args = self.get_object(state['_py_factory_args'], obj)
             sub_obj = factory(*factory_args)
+            meta_fields = ('_py_factory', '_py_factory_args')
+        state = dict([(name, value) for name, value in state.iteritems()
+                      if name not in meta_fields])
         if len(state):
             sub_obj_state = self.get_object(state, obj)
             if hasattr(sub_obj, '__setstate__'):
@@ -533,9 +1070,9 @@ class ObjectReader(object):
             return self.simple_resolve(state['path'])
 
         # Give the custom serializers a chance to weigh in.
-        for serializer in SERIALIZERS:
-            if serializer.can_read(state):
-                return serializer.read(state)
+        serializer = SERIALIZERS.get_reader(state)
+        if serializer is not None:
+            return serializer.read(state)
 
         if isinstance(state, dict) and (
             '_py_factory' in state
@@ -545,6 +1082,12 @@ class ObjectReader(object):
             # Load a non-persistent object.
             return self.get_non_persistent_object(state, obj)
         if isinstance(state, (tuple, list)):
+            if LAZY_SUB_DOCUMENTS and self.preferPersistent:
+                # Defer the conversion of the items until the list is used.
+                sub_obj = LazyPersistentList(self, state, obj)
+                sub_obj._p_mongo_doc_object = obj
+                sub_obj._p_jar = self._jar
+                return sub_obj
             # All lists are converted to persistent lists, so that their state
             # changes are noticed. Also make sure that all value states are
             # converted to objects.
@@ -555,6 +1098,12 @@ class ObjectReader(object):
                 sub_obj._p_jar = self._jar
             return sub_obj
         if isinstance(state, dict):
+            if LAZY_SUB_DOCUMENTS and self.preferPersistent:
+                # Defer the conversion of the values until the dict is used.
+                sub_obj = LazyPersistentDict(self, state, obj)
+                sub_obj._p_mongo_doc_object = obj
+                sub_obj._p_jar = self._jar
+                return sub_obj
             # All dictionaries are converted to persistent dictionaries, so
             # that state changes are detected. Also convert all value states
             # to objects.
@@ -573,24 +1122,82 @@ class ObjectReader(object):
             return sub_obj
         return state
 
+    def get_cached_state(self, dbref):
+        cache = self._jar.state_cache
+        # Cached states can only be validated using the serial maintained by
+        # the conflict handler.
+        field_name = getattr(self._jar.conflict_handler, 'field_name', None)
+        if cache is None or field_name is None:
+            return None
+        doc = cache.get(dbref)
+        if doc is None or field_name not in doc:
+            return None
+        # Only load the serial to check whether the cached state is still
+        # current.
+        coll = self._jar.get_collection(dbref.database, dbref.collection)
+        cur_doc = coll.find_one({'_id': dbref.id}, fields=(field_name,))
+        if cur_doc is None or cur_doc.get(field_name) != doc[field_name]:
+            cache.invalidate(dbref)
+            return None
+        return doc
+
+    def cache_state(self, dbref, doc):
+        cache = self._jar.state_cache
+        field_name = getattr(self._jar.conflict_handler, 'field_name', None)
+        if cache is None or field_name is None or field_name not in doc:
+            return
+        cache.put(dbref, doc)
+
+    def get_prefetch_refs(self, klass, doc):
+        # Classes can list the attributes whose referenced objects should be
+        # loaded together with the document.
+        names = getattr(klass, '_p_mongo_prefetch', None)
+        if not names:
+            return []
+        refs = []
+        for name in names:
+            if name in doc:
+                collect_references(doc[name], refs)
+        return refs
+
     def set_ghost_state(self, obj, doc=None):
         __traceback_info__ = (obj, doc)
         # Check whether the object state was stored on the object itself.
         if doc is None:
             doc = getattr(obj, '_p_mongo_state', None)
+        # Check whether an unchanged state is available from the cache.
+        if doc is None:
+            doc = self.get_cached_state(obj._p_oid)
         # Look up the object state by coll_name and oid.
         if doc is None:
             coll = self._jar.get_collection(
                 obj._p_oid.database, obj._p_oid.collection)
-            doc = coll.find_one({'_id': obj._p_oid.id})
+            deferred = getattr(obj.__class__, '_p_mongo_deferred', None)
+            if deferred:
+                # Exclude the deferred fields. The partial document must not
+                # be cached.
+                doc = coll.find_one(
+                    {'_id': obj._p_oid.id},
+                    fields=dict([(name, False) for name in deferred]))
+                if doc is not None:
+                    self._jar._deferred_objects[obj._p_oid] = obj
+            else:
+                doc = coll.find_one({'_id': obj._p_oid.id})
+                if doc is not None:
+                    self.cache_state(obj._p_oid, doc)
         # Check that we really have a state doc now.
         if doc is None:
             raise ImportError(obj._p_oid)
-        # Create a copy of the doc, so that we can modify it.
-        state_doc = copy.deepcopy(doc)
-        # Remove unwanted attributes.
-        state_doc.pop('_id')
-        state_doc.pop('_py_persistent_type', None)
+        # Load all referenced documents the class wants to have prefetched
+        # at once, before the ghosts are created.
+        refs = self.get_prefetch_refs(obj, doc)
+        if refs:
+            self._jar._load_states(refs)
+        # Create a shallow copy of the doc without the unwanted attributes,
+        # so that the conflict handler can modify it. A deep copy is not
+        # needed, since get_object() never modifies the document.
+        state_doc = dict([(name, value) for name, value in doc.iteritems()
+                          if name not in ('_id', '_py_persistent_type')])
         # Allow the conflict handler to modify the object or state document
         # before it is set on the object.
         self._jar.conflict_handler.on_before_set_state(obj, state_doc)
@@ -610,6 +1217,30 @@ class ObjectReader(object):
         # Set the state.
         obj.__setstate__(state)
 
+    def set_deferred_state(self, obj):
+        __traceback_info__ = obj
+        self._jar._deferred_objects.pop(obj._p_oid, None)
+        names = [name for name in getattr(obj.__class__, '_p_mongo_deferred', ())
+                 if name not in obj.__dict__]
+        if not names:
+            return
+        coll = self._jar.get_collection(
+            obj._p_oid.database, obj._p_oid.collection)
+        doc = coll.find_one({'_id': obj._p_oid.id}, fields=names)
+        if doc is None:
+            raise ImportError(obj._p_oid)
+        del doc['_id']
+        # Complete the known states of the document, so that later writes and
+        # aborts do not lose the deferred fields.
+        for states in (self._jar._original_states, self._jar._latest_states):
+            if obj._p_oid in states:
+                full_doc = dict(states[obj._p_oid])
+                full_doc.update(doc)
+                states[obj._p_oid] = full_doc
+        # Set the attributes without marking the object as changed.
+        for name, value in doc.items():
+            obj.__dict__[str(name)] = self.get_object(value, obj)
+
     def get_ghost(self, dbref, klass=None):
         # If we can, we return the object from cache.
         try:
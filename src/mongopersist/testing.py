@@ -86,6 +86,8 @@ def resetCaches():
     serialize.COLLECTIONS_WITH_TYPE.__init__()
     serialize.AVAILABLE_NAME_MAPPINGS.__init__()
     serialize.PATH_RESOLVE_CACHE = {}
+    serialize.REDUCE_PLAN_CACHE = {}
+    serialize.LOAD_PLAN_CACHE = {}
 
 cleanup.addCleanUp(resetCaches)
 atexit.register(dropDB)
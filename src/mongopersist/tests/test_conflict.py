@@ -14,7 +14,9 @@
 """Mongo  Tests"""
 import doctest
 import persistent
+import pymongo
 import transaction
+from pprint import pprint
 
 from mongopersist import conflict, datamanager, interfaces, testing
 
@@ -34,6 +36,15 @@ class MergerList(persistent.Persistent):
         merged['list'] = sorted(list(set(cur['list']).union(set(new['list']))))
         return merged
 
+class Counter(persistent.Persistent):
+    _p_mongo_merge = {'hits': 'add', 'tags': 'union'}
+    def __init__(self):
+        self.hits = 0
+        self.tags = []
+        self.status = 'new'
+    def __repr__(self):
+        return '<%s %r>' %(self.__class__.__name__, self.hits)
+
 def doctest_create_conflict_error():
     r"""create_conflict_error(): General Test
 
@@ -197,6 +208,23 @@ def doctest_SimpleSerialConflictHandler_basic():
 
     As you can see, the serial number is omitted from the comparison, because
     it does not represent part of the object state, but is state meta-data.
+    It does not matter whether only one of the states has a serial:
+
+      >>> handler.is_same(
+      ...     obj,
+      ...     {'name': 'one', '_py_serial': 1},
+      ...     {'name': 'one'})
+      True
+      >>> handler.is_same(
+      ...     obj,
+      ...     {'name': 'one', '_py_serial': 1},
+      ...     {'name': 'one', 'age': 1})
+      False
+      >>> handler.is_same(
+      ...     obj,
+      ...     {'name': 'one', 'age': 1},
+      ...     {'name': 'one', '_py_serial': 1})
+      False
 
     Let's check the conflict checking methods now. Initially, there are no
     conflicts:
@@ -219,6 +247,38 @@ def doctest_SimpleSerialConflictHandler_basic():
       ConflictError: database conflict error ...
     """
 
+def doctest_SimpleSerialConflictHandler_check_conflicts_batch():
+    r"""class SimpleSerialConflictHandler: checking many objects
+
+    The serials of all objects of a collection are checked using a single
+    query:
+
+      >>> dm.conflict_handler = handler = \
+      ...     conflict.SimpleSerialConflictHandler(dm)
+      >>> objs = [Foo('one'), Foo('two'), Foo('three')]
+      >>> for obj in objs:
+      ...     ref = dm.insert(obj)
+      >>> dm.tpc_finish(None)
+
+      >>> [obj for obj, coll in handler._find_conflicting_objects(objs)]
+      []
+      >>> handler.has_conflicts(objs)
+      False
+      >>> handler.check_conflicts(objs + [Foo('new')])
+
+    Only the objects whose serial changed are reported as conflicting:
+
+      >>> objs[1]._p_serial = conflict.p64(3)
+      >>> [obj for obj, coll in handler._find_conflicting_objects(objs)]
+      [<Foo 'two'>]
+      >>> handler.has_conflicts(objs)
+      True
+      >>> handler.check_conflicts(objs)
+      Traceback (most recent call last):
+      ...
+      ConflictError: database conflict error ...
+    """
+
 def doctest_SimpleSerialConflictHandler_full():
     r"""class SimpleSerialConflictHandler: Full conflict test.
 
@@ -303,6 +363,105 @@ def doctest_ResolvingSerialConflictHandler_basic():
 
     """
 
+def doctest_merge_documents():
+    r"""merge_documents(): General Test
+
+    Fields changed in only one of the documents are taken from that
+    document:
+
+      >>> orig = {'hits': 1, 'status': 'new', 'tags': ['a']}
+      >>> pprint(conflict.merge_documents(
+      ...     orig,
+      ...     {'hits': 1, 'status': 'done', 'tags': ['a']},
+      ...     {'hits': 2, 'status': 'new', 'tags': ['a']},
+      ...     {}))
+      {'hits': 2, 'status': 'done', 'tags': ['a']}
+
+    Fields changed in both documents are merged using the declared
+    strategy:
+
+      >>> strategies = {'hits': 'add', 'tags': 'union',
+      ...               'status': 'last-writer-wins'}
+      >>> pprint(conflict.merge_documents(
+      ...     orig,
+      ...     {'hits': 3, 'status': 'done', 'tags': ['a', 'b']},
+      ...     {'hits': 2, 'status': 'failed', 'tags': ['a', 'c']},
+      ...     strategies))
+      {'hits': 4, 'status': 'failed', 'tags': ['a', 'b', 'c']}
+
+    Strategies can also be callables:
+
+      >>> conflict.merge_documents(
+      ...     orig, {'hits': 3}, {'hits': 2}, {'hits': lambda o, c, n: max(c, n)})
+      {'hits': 3}
+
+    Removed fields stay removed:
+
+      >>> conflict.merge_documents(orig, {'hits': 1}, orig, {})
+      {'hits': 1}
+
+    If a field was changed in both documents and no strategy is declared,
+    the documents cannot be merged:
+
+      >>> conflict.merge_documents(
+      ...     orig, {'status': 'done'}, {'status': 'failed'}, {}) is None
+      True
+    """
+
+def doctest_ResolvingSerialConflictHandler_merge():
+    r"""class ResolvingSerialConflictHandler: Merging fields
+
+    Classes can declare how to merge their fields using the
+    ``_p_mongo_merge`` attribute:
+
+      >>> dm.conflict_handler = conflict.ResolvingSerialConflictHandler(dm)
+      >>> dm.reset()
+      >>> counter_ref = dm.insert(Counter())
+      >>> dm.reset()
+
+      >>> counter_A = dm.load(counter_ref)
+      >>> counter_A.hits
+      0
+
+      >>> dm_B = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.ResolvingSerialConflictHandler)
+      >>> counter_B = dm_B.load(counter_ref)
+      >>> counter_B.hits += 1
+      >>> counter_B.tags.append('b')
+      >>> dm_B.tpc_finish(None)
+
+    The concurrent changes are merged:
+
+      >>> counter_A.hits += 1
+      >>> counter_A.tags.append('a')
+      >>> counter_A.status = 'done'
+      >>> dm.flush()
+      >>> coll = dm._get_collection_from_object(counter_A)
+      >>> pprint(coll.find_one({}, fields=('hits', 'tags', 'status')))
+      {u'_id': ObjectId('...'),
+       u'hits': 2,
+       u'status': u'done',
+       u'tags': [u'b', u'a']}
+
+    Fields without a declared strategy cannot be merged, if both
+    transactions changed them:
+
+      >>> dm.reset()
+      >>> counter_A = dm.load(counter_ref)
+      >>> counter_A.hits
+      2
+      >>> counter_B = dm_B.load(counter_ref)
+      >>> counter_B.status = 'failed'
+      >>> dm_B.tpc_finish(None)
+
+      >>> counter_A.status = 'closed'
+      >>> dm.flush()
+      Traceback (most recent call last):
+      ...
+      ConflictError: database conflict error ...
+    """
+
 def doctest_ResolvingSerialConflictHandler_full():
     r"""class ResolvingSerialConflictHandler: Full conflict test.
 
@@ -357,6 +516,147 @@ def doctest_ResolvingSerialConflictHandler_full():
         {u'list': [1, 2, 3, 4, 5], u'_id': ObjectId('...'), u'_py_serial': 3}
     """
 
+def doctest_CompareAndSwapConflictHandler_full():
+    r"""class CompareAndSwapConflictHandler: Full conflict test.
+
+    This conflict handler does not check for conflicts before writing.
+    Instead documents are only updated, if their serial did not change:
+
+      >>> dm.conflict_handler = handler = \
+      ...     conflict.CompareAndSwapConflictHandler(dm)
+      >>> dm.reset()
+      >>> foo_ref = dm.insert(Foo('one'))
+      >>> ml_ref = dm.insert(MergerList([1, 2, 3]))
+      >>> dm.reset()
+
+      >>> foo_A = dm.load(foo_ref)
+      >>> handler.get_store_spec(foo_A)
+      {'_id': ObjectId('...'), '_py_serial': 1}
+
+    Checking for conflicts is a no-op:
+
+      >>> handler.check_conflicts([foo_A])
+
+    Let's now create a conflict by modifying the objects in another
+    transaction:
+
+      >>> dm_B = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.CompareAndSwapConflictHandler)
+      >>> foo_B = dm_B.load(foo_ref)
+      >>> foo_B.name = 'eins'
+      >>> ml_B = dm_B.load(ml_ref)
+      >>> ml_B.list.append(4)
+      >>> ml_B._p_changed = True
+      >>> dm_B.tpc_finish(None)
+
+    Objects that cannot resolve conflicts raise a conflict error when they
+    are written:
+
+      >>> foo_A.name = '1'
+      >>> dm.flush()
+      Traceback (most recent call last):
+      ...
+      ConflictError: database conflict error
+          (oid DBRef('mongopersist.tests.test_conflict.Foo',
+                     ObjectId('4f74bf0237a08e3085000002'),
+                     'mongopersist_test'),
+           class Foo, orig serial 1, cur serial 2, new serial 2)
+
+      >>> coll = dm._get_collection_from_object(foo_A)
+      >>> coll.find_one({})
+      {u'_id': ObjectId('...'), u'_py_serial': 2, u'name': u'eins'}
+
+    Otherwise the conflict is resolved and the resolved state is written:
+
+      >>> dm.reset()
+      >>> ml_A = dm.load(ml_ref)
+      >>> ml_A.list = [1, 2, 3, 5]
+      >>> ml_A._p_serial = conflict.p64(1)
+      >>> dm.flush()
+      >>> ml_A.list
+      [1, 2, 3, 4, 5]
+
+      >>> coll = dm._get_collection_from_object(ml_A)
+      >>> coll.find_one({})
+      {u'list': [1, 2, 3, 4, 5], u'_id': ObjectId('...'), u'_py_serial': 3}
+    """
+
+def doctest_CompareAndSwapConflictHandler_commit():
+    r"""class CompareAndSwapConflictHandler: Conflicts during commit.
+
+    The changes are written in the first phase of the commit, so that
+    conflicts are raised before any resource manager voted:
+
+      >>> dm.conflict_handler = conflict.CompareAndSwapConflictHandler(dm)
+      >>> dm.reset()
+      >>> foo_ref = dm.insert(Foo('one'))
+      >>> dm.reset()
+      >>> foo_A = dm.load(foo_ref)
+
+      >>> dm_B = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.CompareAndSwapConflictHandler)
+      >>> dm_B.load(foo_ref).name = 'eins'
+      >>> dm_B.tpc_finish(None)
+
+      >>> foo_A.name = '1'
+      >>> transaction.commit()
+      Traceback (most recent call last):
+      ...
+      ConflictError: database conflict error
+          (oid DBRef('mongopersist.tests.test_conflict.Foo',
+                     ObjectId('4f74bf0237a08e3085000002'),
+                     'mongopersist_test'),
+           class Foo, orig serial 1, cur serial 2, new serial 2)
+      >>> transaction.abort()
+
+      >>> coll = dm._get_collection_from_object(foo_A)
+      >>> coll.find_one({})
+      {u'_id': ObjectId('...'), u'_py_serial': 2, u'name': u'eins'}
+
+    Without a conflict, the changes are committed as usual. Every object is
+    only written once:
+
+      >>> foo_A = dm.load(foo_ref)
+      >>> foo_A.name = 'zwei'
+
+      >>> writes = []
+      >>> orig_store = dm._writer.store
+      >>> def store(obj, *args, **kw):
+      ...     writes.append(obj)
+      ...     return orig_store(obj, *args, **kw)
+      >>> dm._writer.store = store
+
+      >>> transaction.commit()
+      >>> writes
+      [<Foo 'zwei'>]
+      >>> coll.find_one({})
+      {u'_id': ObjectId('...'), u'_py_serial': 3, u'name': u'zwei'}
+    """
+
+def doctest_CompareAndSwapConflictHandler_unacknowledged():
+    r"""class CompareAndSwapConflictHandler: Unacknowledged writes.
+
+    Conflicts can only be detected, if the server reports whether the
+    document was matched. Unacknowledged writes are therefore refused:
+
+      >>> foo_ref = dm.insert(Foo('one'))
+      >>> dm.reset()
+
+      >>> unsafe_conn = pymongo.Connection('localhost', 27017, tz_aware=False)
+      >>> dm_U = datamanager.MongoDataManager(
+      ...     unsafe_conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.CompareAndSwapConflictHandler)
+      >>> dm_U.load(foo_ref).name = 'eins'
+      >>> dm_U.flush()
+      Traceback (most recent call last):
+      ...
+      ValueError: ('Compare-and-swap conflict detection requires
+                    acknowledged writes.', <Foo 'eins'>)
+      >>> unsafe_conn.disconnect()
+    """
+
 def test_suite():
     return doctest.DocTestSuite(
         setUp=testing.setUp, tearDown=testing.tearDown,
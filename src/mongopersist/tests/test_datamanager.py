@@ -30,6 +30,10 @@ class Foo(persistent.Persistent):
     def __repr__(self):
         return '<%s %s>' %(self.__class__.__name__, self.name)
 
+class Broken(object):
+    def __reduce__(self):
+        raise ValueError('cannot be stored')
+
 class Super(persistent.Persistent):
     _p_mongo_collection = 'Super'
 
@@ -55,6 +59,42 @@ class Bar(persistent.Persistent):
         return '<%s %s>' %(self.__class__.__name__, self.name)
 
 
+class Owner(persistent.Persistent):
+    _p_mongo_prefetch = ('items',)
+
+    def __init__(self, name=None, items=()):
+        self.name = name
+        self.items = list(items)
+
+    def __repr__(self):
+        return '<%s %s>' %(self.__class__.__name__, self.name)
+
+
+class Report(serialize.DeferredAttributesMixin, persistent.Persistent):
+    _p_mongo_deferred = ('history',)
+
+    def __init__(self, name=None, history=()):
+        self.name = name
+        self.history = list(history)
+
+    def __repr__(self):
+        return '<%s %s>' %(self.__class__.__name__, self.name)
+
+
+class ReadConnection(object):
+    """A connection reporting the collections it reads from."""
+
+    def __init__(self, conn, db_name=None):
+        self.conn = conn
+        self.db_name = db_name
+
+    def __getitem__(self, name):
+        if self.db_name is None:
+            return ReadConnection(self.conn[name], name)
+        print 'Read from %s.%s' %(self.db_name, name)
+        return self.conn[name]
+
+
 class FooItem(object):
     def __init__(self):
         self.bar = 6
@@ -438,6 +478,138 @@ def doctest_MongoDataManager_flush():
              orig serial 1, cur serial 2, new serial 2)
     """
 
+def doctest_MongoDataManager_flush_bulk():
+    r"""MongoDataManager: flush() with ``BULK_FLUSH``
+
+    When the ``BULK_FLUSH`` flag is set, all changed documents of a collection
+    are written using a single bulk operation instead of one save per object.
+
+      >>> datamanager.BULK_FLUSH = True
+      >>> dm.conflict_handler = conflict.SimpleSerialConflictHandler(dm)
+
+      >>> foo1_ref = dm.insert(Foo('one'))
+      >>> foo2_ref = dm.insert(Foo('two'))
+      >>> foo3_ref = dm.insert(Foo('three'))
+      >>> dm.reset()
+
+    Let's record the bulk writes:
+
+      >>> bulk_saves = []
+      >>> orig_bulk_save = dm._writer._bulk_save
+      >>> def bulk_save(coll, docs):
+      ...     bulk_saves.append((coll.name, len(docs)))
+      ...     orig_bulk_save(coll, docs)
+      >>> dm._writer._bulk_save = bulk_save
+
+    Let's now modify two of the objects and flush them:
+
+      >>> foo1 = dm.load(foo1_ref)
+      >>> foo2 = dm.load(foo2_ref)
+      >>> foo3 = dm.load(foo3_ref)
+      >>> foo1.name = 'One'
+      >>> foo2.name = 'Two'
+      >>> foo3.name = 'three'
+      >>> dm.flush()
+
+    Both changed documents were written in one bulk operation:
+
+      >>> bulk_saves
+      [(...'mongopersist.tests.test_datamanager.Foo', 2)]
+
+      >>> coll = dm._get_collection_from_object(foo1)
+      >>> sorted((doc['name'], doc['_py_serial']) for doc in coll.find())
+      [(u'One', 2), (u'Two', 2), (u'three', 1)]
+
+    The conflict handler hooks were called as well. Note that the unchanged
+    object was not written at all:
+
+      >>> foo1._p_serial, foo2._p_serial, foo3._p_serial
+      ('\x00\x00\x00\x00\x00\x00\x00\x02',
+       '\x00\x00\x00\x00\x00\x00\x00\x02',
+       '\x00\x00\x00\x00\x00\x00\x00\x01')
+
+    The latest states are updated as well:
+
+      >>> dm._latest_states[foo1_ref]['name']
+      'One'
+
+    New objects that are referenced while flushing are inserted and written
+    too:
+
+      >>> foo1.sub = Foo('sub')
+      >>> dm.flush()
+      >>> dm.load(foo1.sub._p_oid).name
+      'sub'
+      >>> coll.find_one({'name': 'sub'})['_py_serial']
+      2
+
+      >>> datamanager.BULK_FLUSH = False
+    """
+
+def doctest_MongoDataManager_state_cache():
+    r"""MongoDataManager: state cache
+
+    A state cache can be shared by several data managers. It survives the
+    reset of the data manager at the end of a transaction, so that unchanged
+    documents do not have to be loaded again.
+
+      >>> from mongopersist import cache
+      >>> state_cache = cache.StateCache(100)
+      >>> dm = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.SimpleSerialConflictHandler,
+      ...     state_cache=state_cache)
+
+      >>> foo_ref = dm.insert(Foo('one'))
+      >>> dm.reset()
+      >>> dm.state_cache is state_cache
+      True
+
+    Loading the object puts its document into the cache:
+
+      >>> dm.load(foo_ref).name
+      u'one'
+      >>> state_cache.get(foo_ref)
+      {u'_id': ObjectId('4f5c114f37a08e2cac000000'), u'_py_serial': 1,
+       u'name': u'one'}
+
+    In the next transaction, the cached state is used, since its serial is
+    still current:
+
+      >>> dm.reset()
+      >>> state_cache.clear()
+      >>> dm.load(foo_ref).name
+      u'one'
+      >>> dm.reset()
+      >>> dm.load(foo_ref).name
+      u'one'
+      >>> state_cache.hits, state_cache.misses
+      (1, 1)
+
+    When another data manager changes the document, the cached state is
+    stale and the document is loaded from Mongo again:
+
+      >>> dm_B = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.SimpleSerialConflictHandler)
+      >>> foo_B = dm_B.load(foo_ref)
+      >>> foo_B.name = 'eins'
+      >>> dm_B.tpc_finish(None)
+
+      >>> dm.reset()
+      >>> dm.load(foo_ref).name
+      u'eins'
+      >>> state_cache.get(foo_ref)['_py_serial']
+      2
+
+    Writing or removing an object invalidates its cached state:
+
+      >>> foo = dm.load(foo_ref)
+      >>> dm.remove(foo)
+      >>> state_cache.get(foo_ref) is None
+      True
+    """
+
 def doctest_MongoDataManager_insert():
     r"""MongoDataManager: insert(obj)
 
@@ -507,6 +679,51 @@ def doctest_MongoDataManager_insert_conflict_detection():
     """
 
 
+def doctest_MongoDataManager_insert_many():
+    r"""MongoDataManager: insert_many(objs)
+
+    This method inserts many objects using one insert per collection:
+
+      >>> foo1, foo2 = Foo('one'), Foo('two')
+      >>> refs = dm.insert_many([foo1, foo2])
+      >>> refs == [foo1._p_oid, foo2._p_oid]
+      True
+      >>> foo1._p_changed, foo2._p_changed
+      (False, False)
+      >>> sorted(obj.name for obj in dm._inserted_objects.values())
+      ['one', 'two']
+
+    When an object cannot be stored, the documents written so far are
+    removed again and the objects do not keep their ids:
+
+      >>> foo3, foo4 = Foo('three'), Foo('four')
+      >>> foo4.broken = Broken()
+      >>> dm.insert_many([foo3, foo4])
+      Traceback (most recent call last):
+      ...
+      ValueError: cannot be stored
+      >>> foo3._p_oid is None, foo4._p_oid is None
+      (True, True)
+      >>> sorted(obj.name for obj in dm._inserted_objects.values())
+      ['one', 'two']
+      >>> coll = dm._get_collection_from_object(foo1)
+      >>> sorted(doc['name'] for doc in coll.find())
+      [u'one', u'two']
+
+    When an id is already used, only the documents written by the call are
+    removed again. The existing document is kept:
+
+      >>> foo5, foo6, foo7 = Foo('five'), Foo('six'), Foo('seven')
+      >>> dm.insert_many([foo5, foo6, foo7], [None, foo1._p_oid.id, None])
+      Traceback (most recent call last):
+      ...
+      DuplicateKeyError: E11000 duplicate key error ...
+      >>> foo5._p_oid is None, foo6._p_oid is None, foo7._p_oid is None
+      (True, True, True)
+      >>> sorted(doc['name'] for doc in coll.find())
+      [u'one', u'two']
+    """
+
 def doctest_MongoDataManager_remove():
     r"""MongoDataManager: remove(obj)
 
@@ -682,6 +899,224 @@ def doctest_MongoDataManager_remove_flush_modify():
     """
 
 
+def doctest_MongoDataManager_load_many():
+    r"""MongoDataManager: load_many(dbrefs)
+
+    This method loads several objects at once. The documents are read using
+    one query per collection:
+
+      >>> foo1_ref = dm.insert(Foo('one'))
+      >>> foo2_ref = dm.insert(Foo('two'))
+      >>> super_ref = dm.insert(Super('super'))
+      >>> dm.reset()
+
+      >>> objs = dm.load_many([foo1_ref, super_ref, foo2_ref])
+      >>> [obj._p_changed for obj in objs]
+      [None, None, None]
+
+    The states are available now, so activating the objects does not cause
+    any further Mongo access:
+
+      >>> set(dm._latest_states) == set([foo1_ref, foo2_ref, super_ref])
+      True
+      >>> objs
+      [<Foo one>, <Super super>, <Foo two>]
+
+    The objects are the same ones that ``load()`` returns:
+
+      >>> dm.load(foo1_ref) is objs[0]
+      True
+
+    Already loaded ghosts can be prefetched as well:
+
+      >>> dm.reset()
+      >>> foo1 = dm.load(foo1_ref)
+      >>> foo2 = dm.load(foo2_ref)
+      >>> dm._latest_states
+      {}
+      >>> dm.prefetch([foo1, foo2])
+      >>> len(dm._latest_states)
+      2
+      >>> foo1.name, foo2.name
+      (u'one', u'two')
+
+    When parallel loads are enabled, the collections are queried at the same
+    time using threads:
+
+      >>> datamanager.PARALLEL_LOADS = True
+      >>> dm.reset()
+      >>> objs = dm.load_many([foo1_ref, super_ref, foo2_ref])
+      >>> set(dm._latest_states) == set([foo1_ref, foo2_ref, super_ref])
+      True
+      >>> objs
+      [<Foo one>, <Super super>, <Foo two>]
+
+    The queries are processed by the spec processor like all other queries:
+
+      >>> from zope.testing.cleanup import CleanUp as PlacelessSetup
+      >>> PlacelessSetup().setUp()
+      >>> processed = []
+      >>> class Processor(object):
+      ...     def __init__(self, context):
+      ...         pass
+      ...     def process(self, collection, spec):
+      ...         processed.append(collection.name)
+      ...         return spec
+      >>> import zope.interface
+      >>> from zope.component import provideAdapter
+      >>> provideAdapter(
+      ...     Processor,
+      ...     (zope.interface.Interface,), interfaces.IMongoSpecProcessor)
+
+      >>> dm.reset()
+      >>> objs = dm.load_many([foo1_ref, super_ref, foo2_ref])
+      >>> 'mongopersist.tests.test_datamanager.Foo' in processed
+      True
+      >>> 'Super' in processed
+      True
+
+      >>> PlacelessSetup().tearDown()
+      >>> datamanager.PARALLEL_LOADS = False
+    """
+
+def doctest_MongoDataManager_prefetch_references():
+    r"""MongoDataManager: prefetching references
+
+    Classes can list the attributes whose referenced objects should be loaded
+    together with the document using the ``_p_mongo_prefetch`` attribute:
+
+      >>> foo1 = Foo('one')
+      >>> foo2 = Foo('two')
+      >>> foo1_ref = dm.insert(foo1)
+      >>> foo2_ref = dm.insert(foo2)
+      >>> owner_ref = dm.insert(Owner('owner', [foo1, foo2]))
+      >>> owner2_ref = dm.insert(Owner('owner 2', [foo2]))
+      >>> dm.reset()
+
+    When the owner is activated, the documents of all its items are loaded
+    using a single query:
+
+      >>> owner = dm.load(owner_ref)
+      >>> owner.name
+      u'owner'
+      >>> set(dm._latest_states) == set([owner_ref, foo1_ref, foo2_ref])
+      True
+      >>> owner.items
+      [<Foo one>, <Foo two>]
+
+    When loading many objects at once, the references of all objects are
+    loaded together as well:
+
+      >>> dm.reset()
+      >>> owners = dm.load_many([owner_ref, owner2_ref])
+      >>> set(dm._latest_states) == set(
+      ...     [owner_ref, owner2_ref, foo1_ref, foo2_ref])
+      True
+      >>> owners[1].items
+      [<Foo two>]
+    """
+
+def doctest_MongoDataManager_load_deferred():
+    r"""MongoDataManager: load_deferred()
+
+    Classes can list attributes that are not loaded when the object is
+    activated using the ``_p_mongo_deferred`` attribute:
+
+      >>> report_ref = dm.insert(Report('report', ['created', 'edited']))
+      >>> dm.reset()
+
+      >>> report = dm.load(report_ref)
+      >>> report.name
+      u'report'
+      >>> 'history' in report.__dict__
+      False
+      >>> sorted(dm._latest_states[report_ref].keys())
+      [u'_id', u'name']
+
+    The deferred attributes are loaded on first access, without marking the
+    object as changed:
+
+      >>> report.history
+      [u'created', u'edited']
+      >>> report._p_changed
+      False
+      >>> sorted(dm._latest_states[report_ref].keys())
+      [u'_id', u'history', u'name']
+
+    Partially loaded objects are completed before they are modified, so
+    that the deferred fields are never lost when writing:
+
+      >>> dm.reset()
+      >>> report = dm.load(report_ref)
+      >>> report.name = u'Report'
+      >>> 'history' in report.__dict__
+      True
+      >>> dm.flush()
+
+      >>> pprint(dm._get_collection_from_object(report).find_one(
+      ...     {}, fields=('name', 'history')))
+      {u'_id': ObjectId('4e7ddf12e138237403000000'),
+       u'history': [u'created', u'edited'],
+       u'name': u'Report'}
+
+    The same is true when dumping an object that is not registered:
+
+      >>> dm.reset()
+      >>> report = dm.load(report_ref)
+      >>> report.name
+      u'Report'
+      >>> report.__dict__['name'] = u'report'
+      >>> dm.dump(report)
+      DBRef('mongopersist.tests.test_datamanager.Report',
+            ObjectId('4e7ddf12e138237403000000'),
+            'mongopersist_test')
+
+      >>> pprint(dm._get_collection_from_object(report).find_one(
+      ...     {}, fields=('name', 'history')))
+      {u'_id': ObjectId('4e7ddf12e138237403000000'),
+       u'history': [u'created', u'edited'],
+       u'name': u'report'}
+    """
+
+def doctest_MongoDataManager_read_connection():
+    r"""MongoDataManager: read_connection
+
+    Queries can be sent to another connection, for example to a secondary:
+
+      >>> foo_ref = dm.insert(Foo('one'))
+      >>> dm.tpc_finish(None)
+
+      >>> dm = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     read_connection=ReadConnection(conn))
+      >>> coll = dm.get_collection_from_object(Foo())
+      >>> coll.find_one({})['name']
+      Read from mongopersist_test.mongopersist.tests.test_datamanager.Foo
+      u'one'
+
+    The read connection is kept when the data manager is reset:
+
+      >>> dm.reset()
+      >>> foo = dm.load(foo_ref)
+      >>> foo.name
+      Read from mongopersist_test.mongopersist.tests.test_datamanager.Foo
+      u'one'
+
+    Once the transaction wrote to a collection, it is always queried using
+    the primary connection, so that the transaction reads its own writes:
+
+      >>> foo.name = 'eins'
+      >>> coll.find_one({})['name']
+      u'eins'
+
+    A new transaction uses the read connection again:
+
+      >>> dm.tpc_finish(None)
+      >>> coll.find_one({})['name']
+      Read from mongopersist_test.mongopersist.tests.test_datamanager.Foo
+      u'eins'
+    """
+
 def doctest_MongoDataManager_setstate():
     r"""MongoDataManager: setstate()
 
@@ -1402,8 +1837,18 @@ def doctest_MongoDataManager_modify_sub_delete_doc():
 
       >>> foo = dm.root['foo']
       >>> foo.bar.name = 'bar-new'
+      >>> dm._registered_doc_objects[id(foo)].values()
+      [<Bar bar-new>]
       >>> dm.remove(foo)
 
+    All registered sub-objects of the document are looked up using the
+    document object and are not registered anymore:
+
+      >>> dm._registered_objects
+      {}
+      >>> dm._registered_doc_objects
+      {}
+
       >>> dm.tpc_finish(None)
       >>> conn[DBNAME]['mongopersist.tests.test_datamanager.Foo'].find().count()
       0
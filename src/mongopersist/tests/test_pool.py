@@ -0,0 +1,131 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Mongo Connection Pool Tests"""
+import doctest
+import threading
+
+from mongopersist import pool, testing
+
+class FakeConnection(object):
+    def __init__(self, host, port, **kwargs):
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+    def disconnect(self):
+        pass
+    def __repr__(self):
+        return '<%s %s:%s>' %(self.__class__.__name__, self.host, self.port)
+
+def run_in_thread(func):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+def doctest_MongoConnectionPool_per_thread():
+    r"""MongoConnectionPool: one connection per thread
+
+    By default, every thread gets its own connection:
+
+      >>> mpool = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection)
+      >>> conn = mpool.connection
+      >>> conn
+      <FakeConnection localhost:27017>
+      >>> mpool.connection is conn
+      True
+      >>> run_in_thread(lambda: mpool.connection) is conn
+      False
+
+      >>> mpool.created, mpool.reused
+      (2, 1)
+
+      >>> mpool.disconnect()
+    """
+
+def doctest_MongoConnectionPool_shared():
+    r"""MongoConnectionPool: one connection for all threads
+
+    In shared mode, all threads use the same connection, which pools the
+    sockets itself:
+
+      >>> mpool = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection,
+      ...     shared=True, max_pool_size=50)
+      >>> conn = mpool.connection
+      >>> conn.kwargs['max_pool_size']
+      50
+      >>> run_in_thread(lambda: mpool.connection) is conn
+      True
+
+      >>> mpool.created, mpool.reused
+      (1, 1)
+
+    Pools with the same options share the connection:
+
+      >>> mpool2 = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection,
+      ...     shared=True, max_pool_size=50)
+      >>> mpool2.connection is conn
+      True
+      >>> mpool3 = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection,
+      ...     shared=True, max_pool_size=10)
+      >>> mpool3.connection is conn
+      False
+
+    Disconnecting closes the connection for all threads:
+
+      >>> mpool.disconnect()
+      >>> mpool2.connection is conn
+      False
+
+      >>> mpool2.disconnect()
+      >>> mpool3.disconnect()
+    """
+
+def doctest_MongoConnectionPool_fork():
+    r"""MongoConnectionPool: forking
+
+    Connections created in a parent process are not used in a child
+    process. We simulate forking by changing the recorded process id:
+
+      >>> mpool = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection)
+      >>> spool = pool.MongoConnectionPool(
+      ...     logLevel=0, connectionFactory=FakeConnection, shared=True)
+      >>> conn = mpool.connection
+      >>> shared_conn = spool.connection
+
+      >>> pool.PID = -1
+      >>> mpool.connection is conn
+      False
+      >>> spool.connection is shared_conn
+      False
+
+    Afterwards the connections are reused again:
+
+      >>> conn = mpool.connection
+      >>> mpool.connection is conn
+      True
+
+      >>> mpool.disconnect()
+      >>> spool.disconnect()
+    """
+
+def test_suite():
+    return doctest.DocTestSuite(
+        checker=testing.checker,
+        optionflags=testing.OPTIONFLAGS)
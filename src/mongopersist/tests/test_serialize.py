@@ -67,6 +67,16 @@ class CopyReggedConstant(object):
 copy_reg.pickle(CopyReggedConstant, CopyReggedConstant.custom_reduce_fn)
 CopyReggedConstant = CopyReggedConstant()
 
+class OldStyle:
+    pass
+
+class OldStyle2:
+    pass
+
+class OldStyleSerializer(serialize.ObjectSerializer):
+    def can_write(self, obj):
+        return isinstance(obj, OldStyle)
+
 
 def doctest_ObjectSerializer():
     """Test the abstract ObjectSerializer class.
@@ -104,6 +114,46 @@ def doctest_ObjectSerializer():
       NotImplementedError
     """
 
+def doctest_SerializerList():
+    """SerializerList: cached serializer lookup
+
+    The registered serializers are kept in a list that caches which
+    serializer is responsible for an object type or a state's `_py_type`:
+
+      >>> from mongopersist import serializers
+      >>> serializer_list = serialize.SerializerList()
+      >>> serializer_list.get_writer(datetime.date(2013, 1, 1)) is None
+      True
+
+    Modifying the list clears the cache:
+
+      >>> date_serializer = serializers.DateSerializer()
+      >>> serializer_list.append(date_serializer)
+      >>> serializer_list.get_writer(datetime.date(2013, 1, 1)) \
+      ...     is date_serializer
+      True
+      >>> serializer_list.get_reader(
+      ...     {'_py_type': 'datetime.date', 'ordinal': 734869}) \
+      ...     is date_serializer
+      True
+      >>> serializer_list.get_reader({'_py_type': 'datetime.time'}) is None
+      True
+
+      >>> serializer_list.remove(date_serializer)
+      >>> serializer_list.get_writer(datetime.date(2013, 1, 1)) is None
+      True
+
+    The cache distinguishes instances of different old-style classes, even
+    though they all have the same type:
+
+      >>> old_style_serializer = OldStyleSerializer()
+      >>> serializer_list.append(old_style_serializer)
+      >>> serializer_list.get_writer(OldStyle()) is old_style_serializer
+      True
+      >>> serializer_list.get_writer(OldStyle2()) is None
+      True
+    """
+
 def doctest_ObjectWriter_get_collection_name():
     """ObjectWriter: get_collection_name()
 
@@ -215,6 +265,46 @@ def doctest_ObjectWriter_get_non_persistent_state():
       CircularReferenceError: <__main__.This object at 0x3051550>
     """
 
+def doctest_ObjectWriter_get_reduce_plan():
+    r"""ObjectWriter: get_reduce_plan()
+
+    When an object is reduced, the writer remembers how objects of its class
+    reduce, so that further objects do not need to be reduced anymore:
+
+      >>> writer = serialize.ObjectWriter(dm)
+
+      >>> simple = Simple()
+      >>> simple.name = u'one'
+      >>> pprint.pprint(writer.get_non_persistent_state(simple, []))
+      {'_py_type': 'mongopersist.tests.test_serialize.Simple', 'name': u'one'}
+      >>> serialize.REDUCE_PLAN_CACHE[Simple][0]
+      {'_py_type': 'mongopersist.tests.test_serialize.Simple'}
+
+      >>> simple2 = Simple()
+      >>> simple2.name = u'two'
+      >>> pprint.pprint(writer.get_non_persistent_state(simple2, []))
+      {'_py_type': 'mongopersist.tests.test_serialize.Simple', 'name': u'two'}
+
+    The same is true for persistent sub-objects:
+
+      >>> tier2 = Tier2()
+      >>> tier2.name = u'one'
+      >>> pprint.pprint(writer.get_non_persistent_state(tier2, []))
+      {'_py_persistent_type': 'mongopersist.tests.test_serialize.Tier2',
+       'name': u'one'}
+      >>> tier2 = Tier2()
+      >>> pprint.pprint(writer.get_non_persistent_state(tier2, []))
+      {'_py_persistent_type': 'mongopersist.tests.test_serialize.Tier2'}
+
+    Objects with custom reduce output are always reduced:
+
+      >>> writer.get_non_persistent_state(datetime.date(2011, 11, 1), [])
+      {'_py_factory': 'datetime.date',
+       '_py_factory_args': [Binary('\x07\xdb\x0b\x01', 0)]}
+      >>> serialize.REDUCE_PLAN_CACHE[datetime.date] is None
+      True
+    """
+
 def doctest_ObjectWriter_get_non_persistent_state_circluar_references():
     r"""ObjectWriter: get_non_persistent_state(): Circular References
 
@@ -502,6 +592,75 @@ def doctest_ObjectWriter_store():
 
     """
 
+def doctest_get_document_diff():
+    """get_document_diff(): Compute a $set/$unset update
+
+    The function compares two documents and only returns the changed fields:
+
+      >>> pprint.pprint(serialize.get_document_diff(
+      ...     {'_id': 1, 'name': u'top', 'age': 3, 'gone': 1},
+      ...     {'_id': 1, 'name': u'top', 'age': 4, 'new': 2}))
+      {'$set': {'age': 4, 'new': 2}, '$unset': {'gone': True}}
+
+    Identical documents produce an empty update:
+
+      >>> serialize.get_document_diff({'name': u'top'}, {'name': u'top'})
+      {}
+
+    By default, sub-documents are written as a whole:
+
+      >>> orig = {'address': {'city': u'Boston', 'zip': u'01234'}}
+      >>> new = {'address': {'city': u'Maynard', 'zip': u'01234'}}
+      >>> pprint.pprint(serialize.get_document_diff(orig, new))
+      {'$set': {'address': {'city': u'Maynard', 'zip': u'01234'}}}
+
+    But they can also be compared field by field:
+
+      >>> pprint.pprint(serialize.get_document_diff(orig, new, nested=True))
+      {'$set': {'address.city': u'Maynard'}}
+      >>> pprint.pprint(serialize.get_document_diff(
+      ...     orig, {'address': {'city': u'Boston'}}, nested=True))
+      {'$unset': {'address.zip': True}}
+    """
+
+def doctest_ObjectWriter_store_with_document_diffs():
+    """ObjectWriter: store(): WRITE_DOCUMENT_DIFFS = True
+
+    When writing document diffs, only the changed fields of a loaded document
+    are sent to Mongo:
+
+      >>> serialize.WRITE_DOCUMENT_DIFFS = True
+      >>> writer = serialize.ObjectWriter(dm)
+
+      >>> top = Top()
+      >>> top.name = 'top'
+      >>> top.size = 1
+      >>> top_ref = writer.store(top)
+      >>> dm.reset()
+
+      >>> top = dm.load(top_ref)
+      >>> top.size = 2
+      >>> del top.name
+      >>> top.color = 'blue'
+      >>> writer.get_update(dm._latest_states[top_ref],
+      ...                   writer.get_full_state(top))
+      {'$set': {'color': 'blue', 'size': 2}, '$unset': {'name': True}}
+
+      >>> writer.store(top)
+      DBRef('Top', ObjectId('4eb1b16537a08e2d1a000001'), 'mongopersist_test')
+      >>> pprint.pprint(list(conn[DBNAME]['Top'].find()))
+      [{u'_id': ObjectId('4eb1b17937a08e2d29000001'),
+        u'color': u'blue',
+        u'size': 2}]
+
+    The latest state is the full new document:
+
+      >>> pprint.pprint(dm._latest_states[top_ref])
+      {'_id': ObjectId('4eb1b17937a08e2d29000001'), 'color': 'blue', 'size': 2}
+
+      >>> serialize.WRITE_DOCUMENT_DIFFS = False
+    """
+
 def doctest_ObjectWriter_store_with_mongo_store_type():
     """ObjectWriter: store(): _p_mongo_store_type = True
 
@@ -554,6 +713,58 @@ def doctest_ObjectWriter_store_with_new_object_references():
                       u'mongopersist_test')}]
     """
 
+class BulkOperation(object):
+    def __init__(self, coll):
+        self.coll = coll
+        self.ops = []
+    def find(self, spec):
+        self.spec = spec
+        return self
+    def upsert(self):
+        return self
+    def replace_one(self, doc):
+        self.ops.append(('replace', self.spec['_id']))
+    def update_one(self, update):
+        self.ops.append(('update', self.spec['_id']))
+    def execute(self):
+        self.coll.calls.append(('execute', self.ops))
+
+class BulkCollection(object):
+    def __init__(self):
+        self.calls = []
+    def initialize_unordered_bulk_op(self):
+        return BulkOperation(self)
+    def save(self, doc):
+        self.calls.append(('save', doc['_id']))
+    def update(self, spec, update):
+        self.calls.append(('update', spec['_id']))
+
+def doctest_ObjectWriter_bulk_save():
+    """ObjectWriter: _bulk_save()
+
+    When pymongo provides the bulk API, all documents are written using a
+    single bulk operation:
+
+      >>> writer = serialize.ObjectWriter(dm)
+      >>> coll = BulkCollection()
+      >>> orig_BULK_API = serialize.BULK_API
+      >>> serialize.BULK_API = True
+      >>> writer._bulk_save(coll, [(None, {'_id': 1}), (None, {'_id': 2})])
+      >>> coll.calls
+      [('execute', [('replace', 1), ('replace', 2)])]
+
+    Otherwise, for example with pymongo 2.4, each document is saved on its
+    own:
+
+      >>> coll = BulkCollection()
+      >>> serialize.BULK_API = False
+      >>> writer._bulk_save(coll, [(None, {'_id': 1}), (None, {'_id': 2})])
+      >>> coll.calls
+      [('save', 1), ('save', 2)]
+
+      >>> serialize.BULK_API = orig_BULK_API
+    """
+
 def doctest_ObjectReader_simple_resolve():
     """ObjectReader: simple_resolve()
 
@@ -753,6 +964,30 @@ def doctest_ObjectReader_resolve_lookup_with_multiple_maps_dont_read_full():
 
     """
 
+def doctest_ObjectReader_warm_caches():
+    r"""ObjectReader: warm_caches()
+
+    The name map can be loaded into the class resolution caches at once:
+
+      >>> writer = serialize.ObjectWriter(dm)
+      >>> writer.store(Top())
+      DBRef('Top', ObjectId('4eb1e0f237a08e38dd000002'), 'mongopersist_test')
+      >>> writer.store(Top2())
+      DBRef('Top', ObjectId('4eb1e0f237a08e38dd000003'), 'mongopersist_test')
+
+      >>> serialize.AVAILABLE_NAME_MAPPINGS.clear()
+      >>> serialize.PATH_RESOLVE_CACHE.clear()
+
+      >>> reader = serialize.ObjectReader(dm)
+      >>> reader.warm_caches()
+      >>> sorted(serialize.AVAILABLE_NAME_MAPPINGS)
+      [(u'mongopersist_test', u'Top', u'mongopersist.tests.test_serialize.Top'),
+       (u'mongopersist_test', u'Top', u'mongopersist.tests.test_serialize.Top2')]
+      >>> serialize.PATH_RESOLVE_CACHE[
+      ...     u'mongopersist.tests.test_serialize.Top2']
+      <class 'mongopersist.tests.test_serialize.Top2'>
+    """
+
 def doctest_ObjectReader_get_non_persistent_object_py_type():
     """ObjectReader: get_non_persistent_object(): _py_type
 
@@ -773,6 +1008,38 @@ def doctest_ObjectReader_get_non_persistent_object_py_type():
       u'Here'
     """
 
+def doctest_ObjectReader_get_load_plan():
+    """ObjectReader: get_load_plan()
+
+    The reader remembers how to create the objects of a state's class, so
+    that the class is only resolved once:
+
+      >>> reader = serialize.ObjectReader(dm)
+      >>> factory, meta_fields = reader.get_load_plan(
+      ...    {'_py_type': 'mongopersist.tests.test_serialize.Simple'})
+      >>> factory()
+      <mongopersist.tests.test_serialize.Simple object at 0x306f410>
+      >>> meta_fields
+      ('_py_type',)
+      >>> serialize.LOAD_PLAN_CACHE[
+      ...     ('_py_type', 'mongopersist.tests.test_serialize.Simple')][0] \
+      ...     is factory
+      True
+
+      >>> factory, meta_fields = reader.get_load_plan(
+      ...    {'_py_persistent_type': 'mongopersist.tests.test_serialize.Tier2'})
+      >>> factory()
+      <mongopersist.tests.test_serialize.Tier2 object at 0x306f410>
+      >>> meta_fields
+      ('_py_persistent_type',)
+
+    States created by a factory have no plan:
+
+      >>> reader.get_load_plan(
+      ...     {'_py_factory': 'datetime.date', '_py_factory_args': []}) is None
+      True
+    """
+
 def doctest_ObjectReader_get_non_persistent_object_py_persistent_type():
     """ObjectReader: get_non_persistent_object(): _py_persistent_type
 
@@ -907,6 +1174,49 @@ def doctest_ObjectReader_get_object_mapping():
       {1: '1', 2: '2', 3: '3'}
     """
 
+def doctest_ObjectReader_get_object_lazy():
+    """ObjectReader: get_object(): lazy sub-documents
+
+    When lazy sub-documents are enabled, mappings and sequences are not
+    converted until they are used:
+
+      >>> serialize.LAZY_SUB_DOCUMENTS = True
+
+      >>> reader = serialize.ObjectReader(dm)
+      >>> sub = reader.get_object(
+      ...     {'nested': {'items': [1, 2]}, 'dict': {'dict_data': [(1, '1')]}},
+      ...     None)
+      >>> sub.__class__
+      <class 'mongopersist.serialize.LazyPersistentDict'>
+      >>> 'data' in sub.__dict__
+      False
+
+    Accessing the container only converts its direct children:
+
+      >>> nested = sub['nested']
+      >>> 'data' in sub.__dict__
+      True
+      >>> nested.__class__
+      <class 'mongopersist.serialize.LazyPersistentDict'>
+      >>> 'data' in nested.__dict__
+      False
+      >>> nested['items'].__class__
+      <class 'mongopersist.serialize.LazyPersistentList'>
+      >>> nested['items']
+      [1, 2]
+      >>> sub['dict']
+      {1: '1'}
+
+    The conversion does not mark the containers as changed:
+
+      >>> sub._p_changed
+      False
+      >>> nested._p_changed
+      False
+
+      >>> serialize.LAZY_SUB_DOCUMENTS = False
+    """
+
 def doctest_ObjectReader_get_object_constant():
     """ObjectReader: get_object(): constant
 
@@ -984,6 +1294,23 @@ def doctest_ObjectReader_set_ghost_state():
     here, since this document is taken and put back into Mongo when a
     transaction is not committed.
 
+    Also, the document is not modified while the state is set:
+
+      >>> doc = {'_id': top._p_oid.id, '_py_serial': 1, 'name': u'top',
+      ...        'simple': {'_py_type': 'mongopersist.tests.test_serialize.Simple',
+      ...                   'name': u'simple'}}
+      >>> gobj2 = Top()
+      >>> gobj2._p_oid = top._p_oid
+      >>> reader.set_ghost_state(gobj2, doc)
+      >>> gobj2.simple.name
+      u'simple'
+      >>> pprint.pprint(doc)
+      {'_id': ObjectId('4f7487e237a08e1a86000001'),
+       '_py_serial': 1,
+       'name': u'top',
+       'simple': {'_py_type': 'mongopersist.tests.test_serialize.Simple',
+                  'name': u'simple'}}
+
     This state does not change, even when the object is modified:
 
       >>> gobj.name = 'stop'
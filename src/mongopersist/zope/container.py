@@ -13,20 +13,44 @@
 ##############################################################################
 """Mongo Persistence Zope Containers"""
 import UserDict
+import itertools
 import persistent
 import transaction
 import bson.dbref
 import bson.objectid
 import zope.component
+import zope.event
 from bson.errors import InvalidId
 from rwproperty import getproperty, setproperty
 from zope.container import contained, sample
 from zope.container.interfaces import IContainer
 
-from mongopersist import interfaces
+from mongopersist import cache, interfaces
 from mongopersist.zope import interfaces as zinterfaces
 
 USE_CONTAINER_CACHE = True
+# The maximum amount of items a container keeps loaded in a transaction.
+CONTAINER_CACHE_SIZE = None
+# An optional ``ContainerKeyCache`` remembering the item DBRefs across
+# transactions. It needs a data manager with a state cache. A hit still costs
+# a round trip to validate the serial; it only saves loading the document.
+CONTAINER_KEY_CACHE = None
+STREAM_ITEMS = False
+STREAM_BATCH_SIZE = 1000
+
+def _check_name(name):
+    # The same checks ``zope.container.contained.setitem()`` does.
+    if isinstance(name, str):
+        try:
+            name = unicode(name)
+        except UnicodeError:
+            raise TypeError("name not unicode or ascii string")
+    elif not isinstance(name, unicode):
+        raise TypeError("name not unicode or ascii string")
+    if not name:
+        raise ValueError("empty names are not allowed")
+    return name
+
 
 class MongoContained(contained.Contained):
 
@@ -131,6 +155,7 @@ class MongoContainer(contained.Contained,
     _m_mapping_key = 'key'
     _m_parent_key = 'parent'
     _m_remove_documents = True
+    _m_cache_size = None
 
     def __init__(self, collection=None, database=None,
                  mapping_key=None, parent_key=None):
@@ -193,7 +218,17 @@ class MongoContainer(contained.Contained,
         txn = transaction.manager.get()
         if not hasattr(txn, '_v_mongo_container_cache'):
             txn._v_mongo_container_cache = {}
-        return txn._v_mongo_container_cache.setdefault(self, {})
+        try:
+            return txn._v_mongo_container_cache[self]
+        except KeyError:
+            return txn._v_mongo_container_cache.setdefault(
+                self, self._m_create_cache())
+
+    def _m_create_cache(self):
+        size = self._m_cache_size or CONTAINER_CACHE_SIZE
+        if size is None:
+            return {}
+        return cache.ContainerCache(size)
 
     @property
     def _cache_complete(self):
@@ -202,7 +237,43 @@ class MongoContainer(contained.Contained,
         txn = transaction.manager.get()
         if not hasattr(txn, '_v_mongo_container_cache_complete'):
             txn._v_mongo_container_cache_complete = {}
-        return txn._v_mongo_container_cache_complete.get(self, False)
+        if not txn._v_mongo_container_cache_complete.get(self, False):
+            return False
+        # A bounded cache that had to drop items does not list all of them.
+        return not getattr(self._cache, 'evicted', False)
+
+    def _m_get_key_cache_key(self, key, filter):
+        db_name = self._m_database or self._m_jar.default_database
+        return (db_name, self._m_collection, repr(sorted(filter.items())), key)
+
+    def _m_load_cached_item(self, key, filter):
+        # Look up the item using the DBRef remembered from an earlier
+        # transaction. The document is only used, if the state cache of the
+        # data manager confirms that it is still current. Validating the
+        # serial is a query as well, so this saves bandwidth, not round trips.
+        dbref = CONTAINER_KEY_CACHE.get(self._m_get_key_cache_key(key, filter))
+        if dbref is None:
+            return None
+        doc = self._m_jar._reader.get_cached_state(dbref)
+        if doc is None:
+            return None
+        try:
+            if self._cache_get_key(doc) != key:
+                return None
+        except KeyError:
+            return None
+        for name, value in filter.items():
+            if not isinstance(value, dict) and doc.get(name) != value:
+                return None
+        return self._load_one(doc)
+
+    def _m_remember_item(self, key, filter, obj):
+        CONTAINER_KEY_CACHE.put(
+            self._m_get_key_cache_key(key, filter), obj._p_oid)
+        # Make the loaded state available to the next transaction as well.
+        doc = self._m_jar._latest_states.get(obj._p_oid)
+        if doc is not None:
+            self._m_jar._reader.cache_state(obj._p_oid, doc)
 
     def _cache_mark_complete(self):
         txn = transaction.manager.get()
@@ -221,14 +292,67 @@ class MongoContainer(contained.Contained,
         if obj.__parent__ is None:
             obj._v_parent = self
 
+    def _get_dbref(self, doc):
+        return bson.dbref.DBRef(
+            self._m_collection, doc['_id'],
+            self._m_database or self._m_jar.default_database)
+
+    def _prefetch_references(self, docs):
+        # Make the states of all documents available first, so that the
+        # references that the items want to have prefetched are loaded at
+        # once, instead of one by one while the items are loaded.
+        dbrefs = []
+        for doc in docs:
+            if self._cache_get_key(doc) in self._cache:
+                continue
+            dbref = self._get_dbref(doc)
+            self._m_jar._latest_states[dbref] = doc
+            dbrefs.append(dbref)
+        self._m_jar._prefetch_references(dbrefs)
+
+    def _stream_items(self):
+        # Load the items batch by batch while the cursor advances, instead of
+        # loading all items before returning the first.
+        cursor = self.raw_find().batch_size(STREAM_BATCH_SIZE)
+        released = False
+        while True:
+            docs = list(itertools.islice(cursor, STREAM_BATCH_SIZE))
+            if not docs:
+                break
+            self._prefetch_references(docs)
+            batch = []
+            for doc in docs:
+                key = self._cache_get_key(doc)
+                obj = self._load_one(doc)
+                batch.append((key, obj))
+                yield key, obj
+            # Only the current batch is kept in memory.
+            for key, obj in batch:
+                released = self._release_one(key, obj) or released
+        if not released:
+            # Signal the container that the cache is now complete.
+            self._cache_mark_complete()
+
+    def _release_one(self, key, obj):
+        # Forget an item loaded while streaming, unless it was modified. Any
+        # remaining references see a ghost that is loaded again on access.
+        jar = self._m_jar
+        if obj._p_changed or id(obj) in jar._registered_objects:
+            return False
+        self._cache.pop(key, None)
+        jar._object_cache.pop(hash(obj._p_oid), None)
+        jar._latest_states.pop(obj._p_oid, None)
+        jar._original_states.pop(obj._p_oid, None)
+        jar._loaded_objects.pop(id(obj), None)
+        obj._p_deactivate()
+        return True
+
     def _load_one(self, doc):
         obj = self._cache.get(self._cache_get_key(doc))
         if obj is not None:
             return obj
         # Create a DBRef object and then load the full state of the object.
-        dbref = bson.dbref.DBRef(
-            self._m_collection, doc['_id'],
-            self._m_database or self._m_jar.default_database)
+        dbref = self._get_dbref(doc)
         # Stick the doc into the _latest_states:
         self._m_jar._latest_states[dbref] = doc
         obj = self._m_jar.load(dbref)
@@ -250,35 +374,53 @@ class MongoContainer(contained.Contained,
             return obj
         if self._cache_complete:
             raise KeyError(key)
-        # The cache cannot help, so the item is looked up in the database.
         filter = self._m_get_items_filter()
-        filter[self._m_mapping_key] = key
-        obj = self.find_one(filter)
+        if CONTAINER_KEY_CACHE is not None:
+            obj = self._m_load_cached_item(key, filter)
+            if obj is not None:
+                return obj
+        # The cache cannot help, so the item is looked up in the database.
+        spec = dict(filter)
+        spec[self._m_mapping_key] = key
+        obj = self.find_one(spec)
         if obj is None:
             raise KeyError(key)
+        if CONTAINER_KEY_CACHE is not None:
+            self._m_remember_item(key, filter, obj)
         return obj
 
-    def _real_setitem(self, key, value):
-        # Make sure the value is in the database, since we might want
-        # to use its oid.
-        if value._p_oid is None:
-            self._m_jar.insert(value)
+    def _m_insert(self, key, value):
+        # Unlike insert(), insert_many() joins the transaction, so that the
+        # new item is removed again on abort, even though it is never
+        # modified. Without a mapping key, the key is the id of the document.
+        ids = None
+        if self._m_mapping_key is None:
+            ids = [bson.objectid.ObjectId(key)]
+        self._m_jar.insert_many([value], ids)
 
-        # This call by itself causes the state to change _p_changed to True.
+    def _real_setitem(self, key, value):
+        # Set the key and the parent reference first, so that a new object
+        # is written only once. For objects already in the database, these
+        # calls change _p_changed to True.
         if self._m_mapping_key is not None:
             setattr(value, self._m_mapping_key, key)
         if self._m_parent_key is not None:
             setattr(value, self._m_parent_key, self._m_get_parent_key_value())
+        # Make sure the value is in the database, since we might want
+        # to use its oid.
+        if value._p_oid is None:
+            self._m_insert(key, value)
 
     def __setitem__(self, key, value):
         # When the key is None, we need to determine it.
         if key is None:
             if self._m_mapping_key is None:
-                # Make sure the value is in the database, since we might want
-                # to use its oid.
+                # The oid is the key. New objects get their id right away,
+                # but are only inserted once the parent reference is set.
                 if value._p_oid is None:
-                    self._m_jar.insert(value)
-                key = unicode(value._p_oid.id)
+                    key = unicode(bson.objectid.ObjectId())
+                else:
+                    key = unicode(value._p_oid.id)
             else:
                 # we have _m_mapping_key, use that attribute
                 key = getattr(value, self._m_mapping_key)
@@ -293,6 +435,78 @@ class MongoContainer(contained.Contained,
         # interface would be better in this case.
         self[key] = value
 
+    def add_many(self, values):
+        values = list(values)
+        # Determine all keys up front. When the object id is the key, the ids
+        # of new objects are generated before inserting them.
+        ids = None
+        if self._m_mapping_key is None:
+            ids = [bson.objectid.ObjectId() if value._p_oid is None
+                   else value._p_oid.id for value in values]
+            keys = [unicode(id) for id in ids]
+        else:
+            keys = [_check_name(getattr(value, self._m_mapping_key))
+                    for value in values]
+        # Just like in __setitem__(), objects already stored under their key
+        # are skipped.
+        added = self._m_check_new_keys(keys, values)
+        keys = [keys[idx] for idx in added]
+        values = [values[idx] for idx in added]
+        if ids is not None:
+            ids = [ids[idx] for idx in added]
+        # Set the parent reference and location before the objects are
+        # written, so that each new object is written once.
+        if self._m_parent_key is not None:
+            parent = self._m_get_parent_key_value()
+        events = []
+        for idx, key in enumerate(keys):
+            if self._m_parent_key is not None:
+                setattr(values[idx], self._m_parent_key, parent)
+            values[idx], event = contained.containedEvent(
+                values[idx], self, key)
+            if event is not None:
+                events.append(event)
+        new = [idx for idx, value in enumerate(values) if value._p_oid is None]
+        if new:
+            self._m_jar.insert_many(
+                [values[idx] for idx in new],
+                [ids[idx] for idx in new] if ids is not None else None)
+        for key, value in zip(keys, values):
+            self._cache[key] = value
+        # All items are added before the events are sent, and the container
+        # is only reported as modified once.
+        for event in events:
+            zope.event.notify(event)
+        if events:
+            contained.notifyContainerModified(self)
+        return keys
+
+    def _m_check_new_keys(self, keys, values):
+        seen = set()
+        for key in keys:
+            if key in seen:
+                raise KeyError(key)
+            seen.add(key)
+        # Look up the ids of the items already stored under any of the keys.
+        existing = {}
+        if self._cache_complete:
+            for key in keys:
+                if key in self._cache:
+                    existing[key] = self._cache[key]._p_oid.id
+        else:
+            field = self._m_get_key_field()
+            spec = {field: {'$in': [self._m_get_key_value(key)
+                                    for key in keys]}}
+            for doc in self.raw_find(spec, fields=(field,)):
+                existing[self._cache_get_key(doc)] = doc['_id']
+        added = []
+        for idx, key in enumerate(keys):
+            if key not in existing:
+                added.append(idx)
+            elif getattr(values[idx]._p_oid, 'id', None) != existing[key]:
+                raise KeyError(key)
+        return added
+
     def __delitem__(self, key):
         value = self[key]
         # First remove the parent and name from the object.
@@ -314,6 +528,9 @@ class MongoContainer(contained.Contained,
         # Remove the object from the container cache.
         if USE_CONTAINER_CACHE:
             del self._cache[key]
+        if CONTAINER_KEY_CACHE is not None:
+            CONTAINER_KEY_CACHE.invalidate(self._m_get_key_cache_key(
+                key, self._m_get_items_filter()))
         # Send the uncontained event.
         contained.uncontained(value, self, key)
 
@@ -334,13 +551,57 @@ class MongoContainer(contained.Contained,
     def keys(self):
         return list(self.__iter__())
 
+    def __len__(self):
+        if self._cache_complete:
+            return len(self._cache)
+        return self.raw_find().count()
+
+    def _m_get_key_field(self):
+        return self._m_mapping_key
+
+    def _m_get_key_value(self, key):
+        return key
+
+    def _iter_slice(self, spec, offset, limit, sort):
+        fields = None
+        if self._cache_complete:
+            # All items are in the cache, so only their keys are needed.
+            fields = (self._m_get_key_field(),)
+        cursor = self.raw_find(spec, fields=fields)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        if offset:
+            cursor = cursor.skip(offset)
+        if limit:
+            cursor = cursor.limit(limit)
+        for doc in cursor:
+            if (fields is not None and
+                self._cache_get_key(doc) not in self._cache):
+                # The item was added by another transaction, so the full
+                # document is needed.
+                doc = self.raw_find_one(doc['_id'])
+            yield self._load_one(doc)
+
+    def slice(self, offset=0, limit=None, sort=None):
+        return self._iter_slice({}, offset, limit, sort)
+
+    def slice_after(self, key=None, limit=None):
+        key_field = self._m_get_key_field()
+        spec = {}
+        if key is not None:
+            spec[key_field] = {'$gt': self._m_get_key_value(key)}
+        return self._iter_slice(spec, 0, limit, [(key_field, 1)])
+
     def iteritems(self):
         # If the cache contains all objects, we can just return the cache keys.
         if self._cache_complete:
             return self._cache.iteritems()
-        result = self.raw_find()
+        if STREAM_ITEMS:
+            return self._stream_items()
+        docs = list(self.raw_find())
+        self._prefetch_references(docs)
         items = [(doc[self._m_mapping_key], self._load_one(doc))
-                 for doc in result]
+                 for doc in docs]
         # Signal the container that the cache is now complete.
         self._cache_mark_complete()
         # Return an iterator of the items.
@@ -397,6 +658,12 @@ class IdNamesMongoContainer(MongoContainer):
     def _cache_get_key(self, doc):
         return unicode(doc['_id'])
 
+    def _m_get_key_field(self):
+        return '_id'
+
+    def _m_get_key_value(self, key):
+        return bson.objectid.ObjectId(key)
+
     def _locate(self, obj, doc):
         obj._v_name = unicode(doc['_id'])
         obj._v_parent = self
@@ -414,10 +681,17 @@ class IdNamesMongoContainer(MongoContainer):
         except InvalidId:
             raise KeyError(key)
         filter = self._m_get_items_filter()
-        filter['_id'] = id
-        obj = self.find_one(filter)
+        if CONTAINER_KEY_CACHE is not None:
+            obj = self._m_load_cached_item(key, filter)
+            if obj is not None:
+                return obj
+        spec = dict(filter)
+        spec['_id'] = id
+        obj = self.find_one(spec)
         if obj is None:
             raise KeyError(key)
+        if CONTAINER_KEY_CACHE is not None:
+            self._m_remember_item(key, filter, obj)
         return obj
 
     def __contains__(self, key):
@@ -443,23 +717,18 @@ class IdNamesMongoContainer(MongoContainer):
         # If the cache contains all objects, we can just return the cache keys.
         if self._cache_complete:
             return self._cache.iteritems()
+        if STREAM_ITEMS:
+            return self._stream_items()
         # Load all objects from the database.
-        result = self.raw_find()
+        docs = list(self.raw_find())
+        self._prefetch_references(docs)
         items = [(unicode(doc['_id']), self._load_one(doc))
-                 for doc in result]
+                 for doc in docs]
         # Signal the container that the cache is now complete.
         self._cache_mark_complete()
         # Return an iterator of the items.
         return iter(items)
 
-    def _real_setitem(self, key, value):
-        # We want mongo document ids to be our keys, so pass it to insert(), if
-        # key is provided
-        if value._p_oid is None:
-            self._m_jar.insert(value, bson.objectid.ObjectId(key))
-
-        super(IdNamesMongoContainer, self)._real_setitem(key, value)
-
 
 class AllItemsMongoContainer(MongoContainer):
     _m_parent_key = None
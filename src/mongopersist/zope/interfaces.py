@@ -107,6 +107,28 @@ class IMongoContainer(zope.interface.Interface):
         See pymongo's documentation for details on *args and **kwargs.
         """
 
+    def __len__():
+        """Return the amount of items using a count query.
+
+        If all items are cached within the transaction, the cache is used.
+        """
+
+    def slice(offset=0, limit=None, sort=None):
+        """Return an iterator of the located items of a page.
+
+        ``sort`` is a list of (field, direction) pairs as accepted by pymongo.
+        If all items are cached within the transaction, only the keys of the
+        items are loaded from Mongo.
+        """
+
+    def slice_after(key=None, limit=None):
+        """Return an iterator of the located items after the given key.
+
+        The items are ordered by their key. Passing the key of the last item
+        of a page returns the next page, without skipping over all previous
+        items in Mongo.
+        """
+
     def add(value, key=None):
         """Add an object without necessarily knowing the key of the object.
 
@@ -115,6 +137,15 @@ class IMongoContainer(zope.interface.Interface):
         - otherwise getattr(value, _m_mapping_key)
         """
 
+    def add_many(values):
+        """Add many new objects at once and return their keys.
+
+        The keys are determined like in ``add()`` without a key. All keys and
+        parent references are set before the new objects are written using
+        one bulk insert. The added events are sent once all objects were
+        added, followed by a single container modified event.
+        """
+
     def clear(self):
         """Delete all items from this container.
 
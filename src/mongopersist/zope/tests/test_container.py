@@ -32,7 +32,8 @@ from zope.app.testing import placelesssetup
 from zope.container import contained, btree
 from zope.testing import cleanup, module, renormalizing
 
-from mongopersist import datamanager, interfaces, serialize, testing
+from mongopersist import cache, conflict, datamanager, interfaces
+from mongopersist import serialize, testing
 from mongopersist.zope import container
 
 DBNAME = 'mongopersist_container_test'
@@ -783,6 +784,230 @@ def doctest_MongoContainer_cache_complete():
 
     """
 
+def doctest_MongoContainer_stream_items():
+    """MongoContainer: streaming items
+
+    Let's add a bunch of objects:
+
+      >>> transaction.commit()
+      >>> ppl = dm.root['people'] = container.MongoContainer('person')
+      >>> for name in (u'stephan', u'roy', u'roger', u'adam', u'russ'):
+      ...     ppl[name] = Person(name.capitalize())
+      >>> transaction.commit()
+
+    When streaming is enabled, the items are loaded batch by batch while
+    iterating:
+
+      >>> container.STREAM_ITEMS = True
+      >>> container.STREAM_BATCH_SIZE = 2
+
+      >>> ppl = dm.root['people']
+      >>> items = ppl.iteritems()
+      >>> items.next()
+      (u'stephan', <Person Stephan>)
+      >>> len(ppl._cache) == (1 if container.USE_CONTAINER_CACHE else 0)
+      True
+      >>> ppl._cache_complete
+      False
+
+    Once a batch was iterated, its unmodified items are released again, so
+    that only one batch is kept in memory:
+
+      >>> items.next()
+      (u'roy', <Person Roy>)
+      >>> items.next()
+      (u'roger', <Person Roger>)
+      >>> len(ppl._cache) == (1 if container.USE_CONTAINER_CACHE else 0)
+      True
+      >>> len(dm._object_cache) < 5, len(dm._latest_states) < 5
+      (True, True)
+      >>> len(dm._original_states) < 5
+      True
+
+    Modified items are kept:
+
+      >>> items.next()
+      (u'adam', <Person Adam>)
+      >>> ppl[u'adam'].name = u'Adam Smith'
+      >>> sorted(dict(items))
+      [u'russ']
+      >>> ppl[u'adam']._p_changed
+      True
+
+    Since items were released, the cache is not complete afterwards:
+
+      >>> ppl._cache_complete
+      False
+
+      >>> transaction.commit()
+      >>> dm.root['people'][u'adam']
+      <Person Adam Smith>
+
+      >>> container.STREAM_ITEMS = False
+      >>> container.STREAM_BATCH_SIZE = 1000
+    """
+
+def doctest_MongoContainer_bounded_cache():
+    """MongoContainer: bounded container cache
+
+    The container cache can be bounded, in which case the least recently used
+    items are dropped:
+
+      >>> items = cache.ContainerCache(2)
+      >>> items['a'] = 1
+      >>> items['b'] = 2
+      >>> items.get('a')
+      1
+      >>> items['c'] = 3
+      >>> sorted(items)
+      ['a', 'c']
+      >>> items.evicted
+      True
+      >>> items.get('b') is None
+      True
+      >>> items.hits, items.misses
+      (1, 1)
+
+    Let's add a bunch of objects:
+
+      >>> transaction.commit()
+      >>> ppl = dm.root['people'] = container.MongoContainer('person')
+      >>> for name in (u'stephan', u'roy', u'roger'):
+      ...     ppl[name] = Person(name.capitalize())
+      >>> transaction.commit()
+
+    A container with a bounded cache that had to evict items is never
+    complete:
+
+      >>> container.CONTAINER_CACHE_SIZE = 2
+      >>> ppl = dm.root['people']
+      >>> sorted(dict(ppl.items()))
+      [u'roger', u'roy', u'stephan']
+      >>> len(ppl._cache) == (2 if container.USE_CONTAINER_CACHE else 0)
+      True
+      >>> ppl._cache_complete
+      False
+      >>> sorted(ppl.keys())
+      [u'roger', u'roy', u'stephan']
+
+      >>> transaction.commit()
+      >>> container.CONTAINER_CACHE_SIZE = None
+    """
+
+def doctest_MongoContainer_key_cache():
+    """MongoContainer: cross-transaction key cache
+
+    The container key cache remembers the DBRefs of the items, so that the
+    items can be loaded from the state cache of the data manager in later
+    transactions:
+
+      >>> transaction.commit()
+      >>> container.CONTAINER_KEY_CACHE = key_cache = cache.ContainerKeyCache()
+      >>> state_cache = cache.StateCache()
+      >>> dm = datamanager.MongoDataManager(
+      ...     conn, default_database=DBNAME, root_database=DBNAME,
+      ...     conflict_handler_factory=conflict.SimpleSerialConflictHandler,
+      ...     state_cache=state_cache)
+
+      >>> ppl = dm.root['people'] = container.MongoContainer('person')
+      >>> ppl[u'stephan'] = Person(u'Stephan')
+      >>> transaction.commit()
+      >>> key_cache.clear()
+
+    The first lookup queries Mongo and remembers the item:
+
+      >>> dm.root['people'][u'stephan']
+      <Person Stephan>
+      >>> key_cache.hits, key_cache.misses
+      (0, 1)
+      >>> transaction.commit()
+
+    In the next transaction, only the serial of the item is loaded:
+
+      >>> dm.root['people'][u'stephan']
+      <Person Stephan>
+      >>> key_cache.hits, key_cache.misses
+      (1, 1)
+
+    Removing the item also removes it from the key cache:
+
+      >>> del dm.root['people'][u'stephan']
+      >>> transaction.commit()
+      >>> dm.root['people'][u'stephan']
+      Traceback (most recent call last):
+      ...
+      KeyError: u'stephan'
+
+    Note that a hit still validates the serial of the cached state with a
+    query, so it saves loading the document, but not the round trip.
+
+    Containers using the object id as key validate the cached state against
+    the id:
+
+      >>> dm.root['ids'] = container.IdNamesMongoContainer('person')
+      >>> dm.root['ids'][None] = Person(u'Roy')
+      >>> transaction.commit()
+      >>> key_cache.clear()
+
+      >>> key = dm.root['ids'].keys()[0]
+      >>> dm.root['ids'][key]
+      <Person Roy>
+      >>> transaction.commit()
+      >>> dm.root['ids'][key]
+      <Person Roy>
+      >>> key_cache.hits, key_cache.misses
+      (1, 1)
+
+      >>> transaction.commit()
+      >>> container.CONTAINER_KEY_CACHE = None
+    """
+
+def doctest_MongoContainer_len_and_slice():
+    """MongoContainer: __len__(), slice() and slice_after()
+
+    Let's add a bunch of objects:
+
+      >>> transaction.commit()
+      >>> ppl = dm.root['people'] = container.MongoContainer('person')
+      >>> for name in (u'stephan', u'roy', u'roger', u'adam', u'russ'):
+      ...     ppl[name] = Person(name.capitalize())
+      >>> transaction.commit()
+
+    The length of the container is determined using a count query:
+
+      >>> ppl = dm.root['people']
+      >>> len(ppl)
+      5
+      >>> ppl._cache_complete
+      False
+
+    Pages of items can be loaded without loading the entire container:
+
+      >>> list(ppl.slice(1, 2, sort=[('name', 1)]))
+      [<Person Roger>, <Person Roy>]
+      >>> [item.__name__ for item in ppl.slice(3)]
+      [u'adam', u'russ']
+
+    Alternatively, pages can be loaded by passing the last key of the
+    previous page:
+
+      >>> list(ppl.slice_after(limit=2))
+      [<Person Adam>, <Person Roger>]
+      >>> list(ppl.slice_after(u'roger', limit=2))
+      [<Person Roy>, <Person Russ>]
+      >>> list(ppl.slice_after(u'russ', limit=2))
+      [<Person Stephan>]
+
+    Once all items are cached, the cache is used:
+
+      >>> len(ppl.items())
+      5
+      >>> len(ppl)
+      5
+      >>> list(ppl.slice_after(u'roger', limit=2))
+      [<Person Roy>, <Person Russ>]
+    """
+
 def doctest_IdNamesMongoContainer_basic():
     """IdNamesMongoContainer: basic
 
@@ -1290,6 +1515,106 @@ def doctest_firing_events_MongoContainer():
     """
 
 
+def doctest_MongoContainer_setitem_writes_once():
+    """MongoContainer: adding a new item writes its document once
+
+      >>> transaction.commit()
+      >>> dm.root['c'] = container.MongoContainer('person')
+      >>> x = transaction.begin()
+      >>> dm.root['c'][u'stephan'] = Person(u'Stephan')
+
+    The key and parent reference are part of the inserted document, so the
+    new item is not registered to be written again:
+
+      >>> dm._registered_objects.values()
+      []
+      >>> db = dm._conn[DBNAME]
+      >>> pprint(list(db['person'].find()))
+      [{u'_id': ObjectId('4e7e9d3ae138232d7b000003'),
+        u'key': u'stephan',
+        u'name': u'Stephan',
+        u'parent': DBRef(u'mongopersist.zope.container.MongoContainer',
+                         ObjectId('4e7e9d3ae138232d7b000000'),
+                         u'mongopersist_container_test')}]
+
+    The same is true for containers using the object id as key:
+
+      >>> dm.root['ids'] = container.IdNamesMongoContainer('person')
+      >>> dm.root['ids'][None] = Person(u'Roy')
+      >>> dm._registered_objects.values()
+      []
+      >>> roy = [doc for doc in db['person'].find() if doc['name'] == u'Roy']
+      >>> dm.root['ids'].keys() == [unicode(roy[0]['_id'])]
+      True
+
+    Aborting the transaction removes the inserted item again:
+
+      >>> transaction.abort()
+      >>> len(list(db['person'].find({'name': u'Roy'})))
+      0
+    """
+
+def doctest_MongoContainer_add_many():
+    """MongoContainer: add_many()
+
+      >>> @zope.component.adapter(zope.component.interfaces.IObjectEvent)
+      ... def eventHandler(event):
+      ...     print event
+
+      >>> zope.component.provideHandler(eventHandler)
+
+    Many objects can be added at once. The container is reported as modified
+    only once:
+
+      >>> transaction.commit()
+      >>> dm.root['people'] = people = People()
+      >>> x = transaction.begin()
+      >>> people.add_many(
+      ...     PeoplePerson('Mr Number %.5i' %idx, 20) for idx in xrange(2))
+      <zope.lifecycleevent.ObjectAddedEvent object at ...>
+      <zope.lifecycleevent.ObjectAddedEvent object at ...>
+      <zope.container.contained.ContainerModifiedEvent object at ...>
+      [u'Mr Number 00000', u'Mr Number 00001']
+
+    The people were written once, using one insert, and are not registered
+    to be written again. Only their new addresses are:
+
+      >>> sorted(obj.__class__.__name__
+      ...        for obj in dm._registered_objects.values())
+      ['Address', 'Address']
+      >>> transaction.commit()
+      >>> sorted(people.keys())
+      [u'Mr Number 00000', u'Mr Number 00001']
+      >>> people[u'Mr Number 00001']
+      <PeoplePerson Mr Number 00001 @ 20 [Mr Number 00001]>
+
+    Existing keys are not added again:
+
+      >>> people.add_many([PeoplePerson('Mr Number 00001', 30)])
+      Traceback (most recent call last):
+      ...
+      KeyError: u'Mr Number 00001'
+
+    But adding an object under the key it is already stored with does
+    nothing:
+
+      >>> people.add_many([people[u'Mr Number 00001']])
+      []
+
+    The keys are checked just like when adding a single object:
+
+      >>> people.add_many([PeoplePerson('', 30)])
+      Traceback (most recent call last):
+      ...
+      ValueError: empty names are not allowed
+      >>> people.add_many([PeoplePerson(1, 30)])
+      Traceback (most recent call last):
+      ...
+      TypeError: name not unicode or ascii string
+      >>> transaction.abort()
+    """
+
+
 class PeopleWithIDKeys(container.IdNamesMongoContainer):
     _p_mongo_collection = 'people'
     _m_collection = 'person'